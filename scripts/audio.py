@@ -0,0 +1,495 @@
+import os
+import json
+import signal
+import subprocess
+import re
+import threading
+import queue
+import time
+import numpy as np
+from cache import chunk_id
+import sources
+
+# faster-whisper works on 16 kHz mono float32 samples, so that is what ffmpeg is asked to emit
+SAMPLE_RATE = 16000
+BYTES_PER_SAMPLE = 4
+
+# Same silencedetect settings the silence check has always used
+SILENCE_THRESHOLD_DB = -35
+MIN_SILENCE_SECONDS = 1
+# Speech intervals are widened a little so word onsets and endings below the threshold are not clipped
+SPEECH_PADDING_SECONDS = 0.25
+# Speech ranges less than this apart go to the model as one clip of up to a whisper window, the pause goes along with them
+CLIP_GAP_SECONDS = 3
+CLIP_WINDOW_SECONDS = 30
+# Chunk files waiting for the model in the spool folder, ffmpeg is paused above this
+SPOOL_BYTES = 512 * 1024 * 1024
+# A chunk boundary is moved back into the longest silence within this share of the chunk length before it
+BOUNDARY_SLACK = 0.1
+
+
+def ffmpeg_process(program, options, input_file, arguments, start=0, follow=None, **popen_args):
+    """
+    Start ffmpeg or ffprobe on a recording, options go before the input and arguments after it.
+    A track inside a zip is fed to ffmpeg's stdin by a thread straight out of the zip. A pipe can not seek,
+    so start then goes after the input, where ffmpeg reads up to it and drops what comes before.
+    With a follow event the file is still being written, it is fed as it grows until the event is set.
+    """
+    seek = ["-ss", str(start)] if start else []
+    if follow is not None:
+        # Small probe so decoding starts after a few seconds of audio, a wav being written has no valid length in its header yet
+        options = [*options, "-probesize", "65536"] + (["-ignore_length", "1"] if input_file.lower().endswith(".wav") else [])
+        process = subprocess.Popen([program, *options, "-i", "pipe:0", *seek, *arguments], stdin=subprocess.PIPE, **popen_args)
+        threading.Thread(target=sources.follow, args=(input_file, process, follow), daemon=True).start()
+        return process
+    if sources.split_member(input_file)[1] is None:
+        return subprocess.Popen([program, *options, *seek, "-i", input_file, *arguments], **popen_args)
+    process = subprocess.Popen([program, *options, "-i", "pipe:0", *seek, *arguments], stdin=subprocess.PIPE, **popen_args)
+    threading.Thread(target=sources.feed, args=(input_file, process), daemon=True).start()
+    return process
+
+def run_ffmpeg(program, options, input_file, arguments, start=0, stdout=subprocess.PIPE, text=False):
+    """subprocess.run for ffmpeg_process, stderr is read in a thread so neither pipe can fill up and block ffmpeg."""
+    process = ffmpeg_process(program, options, input_file, arguments, start, stdout=stdout, stderr=subprocess.PIPE, text=text)
+    errors = []
+    reader = threading.Thread(target=lambda: errors.append(process.stderr.read()), daemon=True)
+    reader.start()
+    output = process.stdout.read() if process.stdout is not None else None
+    process.wait()
+    reader.join()
+    for pipe in (process.stdout, process.stderr):
+        if pipe is not None:
+            pipe.close()
+    return subprocess.CompletedProcess(process.args, process.returncode, output, errors[0] if errors else "")
+
+def probe_duration(input_file):
+    """Return the duration of the file in seconds, from ffprobe's json output."""
+    try:
+        result = run_ffmpeg("ffprobe", ["-v", "error", "-show_entries", "format=duration", "-of", "json"], input_file, [], text=True)
+    except FileNotFoundError:
+        return probe_duration_ffmpeg(input_file)
+    if result.returncode != 0:
+        raise ChildProcessError(f"Error: Unable to determine the duration of the file {input_file}.\n {str(result.stderr)}")
+    try:
+        duration = json.loads(result.stdout)["format"].get("duration")
+        # An ogg read from a pipe has no duration up front, its end can not be seeked to
+        if duration in (None, "N/A"):
+            return read_duration(input_file)
+        return float(duration)
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        raise ChildProcessError(f"Error: Failed to parse the duration of the file {input_file}. {e}")
+
+def read_duration(input_file):
+    """Duration by reading every packet of the file without decoding it, for sources that can not tell it up front."""
+    result = run_ffmpeg("ffmpeg", ["-nostdin", "-v", "error"], input_file, ["-map", "0:a:0", "-c", "copy", "-f", "null", "-progress", "pipe:1", "-nostats", "-"], text=True)
+    times = re.findall(r"out_time_us=(\d+)", result.stdout)
+    if result.returncode != 0 or not times:
+        raise ChildProcessError(f"Error: Unable to determine the duration of the file {input_file}.\n {str(result.stderr)}")
+    return int(times[-1]) / 1e6
+
+def probe_duration_ffmpeg(input_file):
+    """Duration scraped from the ffmpeg -i banner, for when ffprobe is missing."""
+    result = run_ffmpeg("ffmpeg", [], input_file, [], stdout=subprocess.DEVNULL, text=True)
+    # Extract the duration from ffmpeg's stderr output
+    duration_line = [line for line in result.stderr.splitlines() if "Duration" in line]
+    if not duration_line:
+        raise ChildProcessError(f"Error: Unable to determine the duration of the file {input_file}.\n {str(result.stderr)}")
+
+    # Clean up the duration string by removing commas and other non-numeric characters
+    duration = duration_line[0].split()[1].replace(",", "").strip()
+    # Like ffprobe, an ogg read from a pipe has no duration up front
+    if duration == "N/A":
+        return read_duration(input_file)
+    try:
+        h, m, s = map(float, duration.split(":"))
+    except ValueError as e:
+        raise ChildProcessError(f"Error: Failed to parse duration '{duration}' of the file {input_file}. {e}")
+    return h * 3600 + m * 60 + s
+
+def decode_pcm(input_file, start, length):
+    """Decode length seconds of the file from start into 16 kHz mono float32 samples with a single seek."""
+    result = run_ffmpeg("ffmpeg", ["-nostdin", "-v", "error"], input_file, [
+        "-t", str(length), "-f", "f32le", "-acodec", "pcm_f32le", "-ac", "1", "-ar", str(SAMPLE_RATE), "-"
+    ], start)
+    if result.returncode != 0:
+        raise ChildProcessError(f"Error: ffmpeg failed decoding {input_file} at {start}.\n {result.stderr.decode('utf-8', errors='replace')}")
+    return np.frombuffer(result.stdout, dtype=np.float32)
+
+def cut_clip(input_file, start, length, output_file):
+    """Copy length seconds of the file from start into output_file with a single seek, without re-encoding."""
+    result = run_ffmpeg("ffmpeg", ["-nostdin", "-v", "error"], input_file, [
+        "-t", str(length), "-map", "0:a:0", "-c", "copy", "-y", output_file
+    ], start)
+    if result.returncode != 0:
+        raise ChildProcessError(f"Error: ffmpeg failed cutting a clip of {input_file} at {start}.\n {result.stderr.decode('utf-8', errors='replace')}")
+
+def silences_between(speech, start, end):
+    """The gaps between the speech intervals that lie within [start, end], cut down to it."""
+    silences = []
+    cursor = 0.0
+    for speech_start, speech_end in [*speech, (float("inf"), float("inf"))]:
+        gap_start, gap_end = max(cursor, start), min(speech_start, end)
+        if gap_end > gap_start:
+            silences.append((gap_start, gap_end))
+        cursor = max(cursor, speech_end)
+        if cursor >= end:
+            break
+    return silences
+
+def chunk_starts(speech, duration, chunk_length_seconds, slack=BOUNDARY_SLACK):
+    """
+    Start of every chunk of a file, at most chunk_length_seconds apart. Every boundary is moved back into the middle of the
+    longest silence in the last slack share of the chunk, so no word is cut in two and the model starts each chunk on a pause.
+    Without speech intervals, or without a silence in reach, the chunk is cut at its full length.
+    """
+    starts = [0.0]
+    while starts[-1] + chunk_length_seconds < duration:
+        boundary = starts[-1] + chunk_length_seconds
+        if speech is not None:
+            silences = silences_between(speech, boundary - chunk_length_seconds * slack, boundary)
+            if silences:
+                longest = max(silences, key=lambda silence: silence[1] - silence[0])
+                boundary = round((longest[0] + longest[1]) / 2, 3)
+        starts.append(boundary)
+    return starts
+
+def cut_chunks(input_file, base_name, out_dir, chunk_length_seconds=1800, start=0, started=None, bounds=None):
+    """
+    Cut the file from start into chunk_length_seconds chunks in out_dir with a single ffmpeg segment muxer pass, without re-encoding.
+    bounds are the starts of the chunks after start when the chunks are not all the same length, like the ones chunk_starts gives.
+    Yields (chunk start, chunk file) as soon as ffmpeg has finished each chunk, it lists them on stdout as it closes them.
+    started is called with the ffmpeg process, so it can be paused or killed from another thread.
+    """
+    extension = os.path.splitext(input_file)[1]
+    if bounds is None:
+        segmenting = ["-segment_time", str(chunk_length_seconds)]
+    else:
+        # The cut times count from the seek, like the timestamps of the output
+        bounds = [bound for bound in bounds if bound > start]
+        segmenting = ["-segment_times", ",".join(str(round(bound - start, 3)) for bound in bounds)] if bounds else ["-segment_time", str(10 ** 9)]
+    process = ffmpeg_process("ffmpeg", ["-nostdin", "-v", "error"], input_file, [
+        "-map", "0:a:0", "-c", "copy", "-f", "segment", *segmenting, "-reset_timestamps", "1",
+        "-segment_list", "pipe:1", "-segment_list_type", "flat", "-y",
+        os.path.join(out_dir, f"{base_name}_chunk_%05d{extension}")
+    ], start, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if started is not None:
+        started(process)
+    try:
+        index = 0
+        for line in process.stdout:
+            if not line.strip():
+                continue
+            if bounds is None:
+                chunk_start = start + index * chunk_length_seconds
+            else:
+                # A duration that was probed short can leave a last bit after the final bound
+                starts = [start] + bounds
+                chunk_start = starts[index] if index < len(starts) else starts[-1] + (index - len(starts) + 1) * chunk_length_seconds
+            yield chunk_start, os.path.join(out_dir, os.path.basename(line.strip()))
+            index += 1
+        process.wait()
+        if process.returncode != 0:
+            raise ChildProcessError(f"Error: ffmpeg failed cutting {input_file} into chunks.\n {process.stderr.read()}")
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        process.stderr.close()
+
+class Segmenter:
+    """
+    Cuts files into chunks ahead of the transcription in a background thread, one ffmpeg pass per file in the order they were added,
+    after the speech detection pass of the file, which places the chunk boundaries in silences. While one speaker file is transcribed
+    the next ones are already being cut, so the model never waits on ffmpeg between speakers.
+    Finished chunks that were not released yet are capped at spool_bytes, ffmpeg is paused while the spool is full.
+    The chunk being written is not counted, so the spool can go over by one chunk.
+    """
+
+    def __init__(self, out_dir, chunk_length_seconds=1800, spool_bytes=SPOOL_BYTES, detect=True):
+        self.out_dir = out_dir
+        self.chunk_length_seconds = chunk_length_seconds
+        self.spool_bytes = spool_bytes
+        self.detect = detect
+        self.files = queue.Queue()
+        self.chunk_queues = {}
+        self.speech_maps = {}
+        self.spooled = {}  # chunk file: size, for every cut chunk not released yet
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.process = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def add(self, input_file, base_name, done=()):
+        """Queue a file to be cut, chunks with an id in done are skipped and cutting starts at the first one that is not."""
+        self.chunk_queues[input_file] = queue.Queue()
+        self.speech_maps[input_file] = queue.Queue(maxsize=1)
+        self.files.put((input_file, base_name, set(done)))
+
+    def chunks(self, input_file):
+        """Yield (chunk start, chunk end, chunk file) of the file in order, waiting for the ones that are not cut yet."""
+        chunks = self.chunk_queues[input_file]
+        while True:
+            item = chunks.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def speech(self, input_file):
+        """Speech intervals of the whole file like detect_speech, None when speech detection is off."""
+        speech = self.speech_maps[input_file].get()
+        self.speech_maps[input_file].put(speech)  # Put back so asking twice does not block
+        if isinstance(speech, Exception):
+            raise speech
+        return speech
+
+    def release(self, chunk_file):
+        """A chunk is done with, removes it from the spool."""
+        with self.lock:
+            self.spooled.pop(chunk_file, None)
+        if os.path.exists(chunk_file):
+            os.remove(chunk_file)
+
+    def run(self):
+        while True:
+            item = self.files.get()
+            if item is None:
+                return
+            input_file, base_name, done = item
+            if self.stop.is_set():
+                self.chunk_queues[input_file].put(None)
+                self.speech_maps[input_file].put(None)
+                continue
+            try:
+                speech = detect_speech(input_file) if self.detect else None
+            except Exception as e:
+                self.speech_maps[input_file].put(e)
+                self.chunk_queues[input_file].put(e)
+                continue
+            self.speech_maps[input_file].put(speech)
+            try:
+                self.cut(input_file, base_name, done, speech)
+                self.chunk_queues[input_file].put(None)
+            except Exception as e:
+                self.chunk_queues[input_file].put(e)
+
+    def cut(self, input_file, base_name, done, speech):
+        duration = probe_duration(input_file)
+        starts = chunk_starts(speech, duration, self.chunk_length_seconds)
+        ends = dict(zip(starts, starts[1:] + [duration]))
+        pending = [start for start in starts if chunk_id(start) not in done]
+        if not pending:
+            return
+        throttle = None
+        def started(process):
+            nonlocal throttle
+            self.process = process
+            throttle = threading.Thread(target=self.throttle, args=(process,), daemon=True)
+            throttle.start()
+        try:
+            for chunk_start, chunk_file in cut_chunks(input_file, base_name, self.out_dir, self.chunk_length_seconds, pending[0], started, starts):
+                if chunk_id(chunk_start) in done:
+                    os.remove(chunk_file)
+                    continue
+                with self.lock:
+                    self.spooled[chunk_file] = os.path.getsize(chunk_file)
+                self.chunk_queues[input_file].put((chunk_start, ends.get(chunk_start, chunk_start + self.chunk_length_seconds), chunk_file))
+        except ChildProcessError:
+            if not self.stop.is_set():
+                raise
+        finally:
+            if throttle is not None:
+                throttle.join()
+
+    def throttle(self, process):
+        # Only finished chunks count, so a paused ffmpeg always has a chunk the consumer will release
+        paused = False
+        while process.poll() is None:
+            with self.lock:
+                full = sum(self.spooled.values()) >= self.spool_bytes
+            if full != paused:
+                os.kill(process.pid, signal.SIGSTOP if full else signal.SIGCONT)
+                paused = full
+            time.sleep(0.2)
+
+    def close(self):
+        """Stop cutting and remove every chunk that was not released."""
+        self.stop.set()
+        self.files.put(None)
+        process = self.process
+        if process is not None and process.poll() is None:
+            process.kill()
+        self.thread.join()
+        for chunk_file in list(self.spooled):
+            self.release(chunk_file)
+
+def stream_pcm(input_file, chunk_length_seconds=1800, prefetch=1, start=0, follow=None):
+    """
+    Decode input_file once with a single long-lived ffmpeg process and yield (offset_seconds, samples)
+    for every chunk_length_seconds of audio, samples being a float32 NumPy array that can be handed straight to model.transcribe.
+    A start above 0 seeks there first, offsets stay relative to the beginning of the file.
+    Decoding happens in a background thread so the next chunk is read while the current one is transcribed,
+    at most prefetch chunks are buffered ahead of the consumer to keep memory bounded.
+    With a follow event the file is still being written, chunks come in as the audio does and the last short one once the event is set.
+    """
+    process = ffmpeg_process("ffmpeg", ["-nostdin", "-v", "error"], input_file, [
+        "-f", "f32le", "-acodec", "pcm_f32le", "-ac", "1", "-ar", str(SAMPLE_RATE), "-"
+    ], start, follow, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    chunk_samples = int(chunk_length_seconds * SAMPLE_RATE)
+    buffers = queue.Queue(maxsize=max(1, prefetch))
+    stop = threading.Event()
+
+    def put(item):
+        # Give up on the put if the consumer went away, otherwise the reader would block forever
+        while not stop.is_set():
+            try:
+                buffers.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def reader():
+        offset = start
+        try:
+            while not stop.is_set():
+                samples = np.empty(chunk_samples, dtype=np.float32)
+                view = memoryview(samples).cast("B")
+                filled = 0
+                while filled < len(view):
+                    read = process.stdout.readinto(view[filled:])
+                    if not read:
+                        break
+                    filled += read
+                count = filled // BYTES_PER_SAMPLE
+                if count == 0:
+                    break
+                if not put((offset, samples[:count])):
+                    return
+                offset += count / SAMPLE_RATE
+                if filled < len(view):
+                    break
+            process.wait()
+            if process.returncode != 0 and not stop.is_set():
+                error = process.stderr.read().decode("utf-8", errors="replace")
+                put(ChildProcessError(f"Error: ffmpeg failed decoding {input_file}.\n {error}"))
+                return
+            put(None)
+        except Exception as e:
+            put(e)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = buffers.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        if process.poll() is None:
+            process.kill()
+        thread.join()
+        process.stdout.close()
+        process.stderr.close()
+
+
+def pad_intervals(intervals, padding=SPEECH_PADDING_SECONDS, start=0.0, end=float("inf")):
+    """Widen every (start, end) interval by padding, clamp them to [start, end] and join the ones that overlap."""
+    merged = []
+    for interval_start, interval_end in intervals:
+        interval_start = max(start, interval_start - padding)
+        interval_end = min(end, interval_end + padding)
+        if merged and interval_start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], interval_end))
+        else:
+            merged.append((interval_start, interval_end))
+    return merged
+
+def speech_from_silences(silences, start=0.0, end=float("inf")):
+    """Turn an ordered list of (start, end) silences into the speech intervals between them."""
+    speech = []
+    cursor = start
+    for silence_start, silence_end in silences:
+        if silence_start > cursor:
+            speech.append((cursor, silence_start))
+        cursor = max(cursor, silence_end)
+    if cursor < end:
+        speech.append((cursor, end))
+    return pad_intervals(speech, start=start, end=end)
+
+def detect_speech(input_file, threshold_db=SILENCE_THRESHOLD_DB, min_silence=MIN_SILENCE_SECONDS):
+    """
+    Run silencedetect once over the whole file and return its speech intervals as (start, end) seconds.
+    The last interval ends at infinity when the file does not end in silence, clip_ranges clamps it to the chunk.
+    """
+    result = run_ffmpeg("ffmpeg", ["-nostdin"], input_file, [
+        "-af", f"silencedetect=n={threshold_db}dB:d={min_silence}", "-f", "null", "-"
+    ], stdout=subprocess.DEVNULL, text=True)
+    if result.returncode != 0:
+        raise ChildProcessError(f"Error: Unable to detect silence in the file {input_file}.\n {str(result.stderr)}")
+
+    silences = []
+    silence_start = None
+    for line in result.stderr.splitlines():
+        match = re.search(r"silence_start: (-?[\d.]+)", line)
+        if match:
+            silence_start = max(0.0, float(match.group(1)))
+            continue
+        match = re.search(r"silence_end: (-?[\d.]+)", line)
+        if match and silence_start is not None:
+            silences.append((silence_start, float(match.group(1))))
+            silence_start = None
+    # A silence running into the end of the file has no silence_end line
+    if silence_start is not None:
+        silences.append((silence_start, float("inf")))
+    return speech_from_silences(silences)
+
+def detect_speech_pcm(samples, offset=0.0, threshold_db=SILENCE_THRESHOLD_DB, min_silence=MIN_SILENCE_SECONDS):
+    """Same as detect_speech but for already decoded samples, so streaming does not need a second decode of the file."""
+    duration = len(samples) / SAMPLE_RATE
+    frame = SAMPLE_RATE // 50  # 20 ms frames
+    frame_count = -(-len(samples) // frame)
+    if frame_count == 0:
+        return []
+    padded = np.zeros(frame_count * frame, dtype=np.float32)
+    padded[:len(samples)] = np.abs(samples)
+    quiet = padded.reshape(frame_count, frame).max(axis=1) < 10 ** (threshold_db / 20)
+
+    # Find the runs of quiet frames, edges alternate between run starts and run ends
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], quiet.astype(np.int8), [0]))))
+    min_frames = min_silence * 50
+    silences = [
+        (offset + run_start * frame / SAMPLE_RATE, offset + min(run_end * frame / SAMPLE_RATE, duration))
+        for run_start, run_end in zip(edges[::2], edges[1::2]) if run_end - run_start >= min_frames
+    ]
+    return speech_from_silences(silences, start=offset, end=offset + duration)
+
+def clip_ranges(speech, start, end):
+    """Cut the speech intervals down to one chunk, returned relative to the chunk start."""
+    clips = []
+    for speech_start, speech_end in speech:
+        if speech_end <= start or speech_start >= end:
+            continue
+        clips.append((max(speech_start, start) - start, min(speech_end, end) - start))
+    return clips
+
+def pack_clips(clips, window=CLIP_WINDOW_SECONDS, max_gap=CLIP_GAP_SECONDS):
+    """
+    Join neighbouring clips into windows of up to window seconds when the pause between them is shorter than max_gap.
+    The model encodes at least one 30 second window per clip, so a talkative track cut at every pause would cost
+    several encoder passes per window and every fragment would lose the words around it. Longer clips are left whole.
+    """
+    packed = []
+    for clip_start, clip_end in clips:
+        if packed and clip_start - packed[-1][1] < max_gap and clip_end - packed[-1][0] <= window:
+            packed[-1] = (packed[-1][0], clip_end)
+        else:
+            packed.append((clip_start, clip_end))
+    return packed
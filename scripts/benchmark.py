@@ -0,0 +1,225 @@
+import os, shutil
+import argparse
+import json
+import subprocess
+import tempfile
+import threading
+import time
+from collections import namedtuple
+import audio
+import merge
+import format
+import transcript
+from cache import journal_dir, assemble_journal
+from metrics import new_metrics, file_metrics, write_metrics, peak_rss_mb
+from segments import RECORD_EXTENSION, seconds_to_hms
+
+# Offline benchmark of everything around the model. Sessions are synthesized with ffmpeg and run through the transcript.py pipeline
+# with a stub in place of WhisperModel, so regressions in splitting, streaming, speech detection, merging and rendering show up without a gpu or a model download.
+
+Segment = namedtuple("Segment", ["start", "end", "text", "avg_logprob", "words"])
+
+class StubModel:
+    """
+    Stands in for WhisperModel.transcribe, one segment for every started 5 seconds of the audio it is asked to transcribe.
+    The lines carry the speaker being transcribed, so the bleed suppression does not take them for copies of each other.
+    """
+    segment_length = 5.0
+    speaker = "stub"
+
+    def transcribe(self, chunk, language=None, vad_filter=False, clip_timestamps=None, word_timestamps=False):
+        if clip_timestamps:
+            clips = list(zip(clip_timestamps[::2], clip_timestamps[1::2]))
+        elif isinstance(chunk, str):
+            # A chunk file cut by the segmenter
+            clips = [(0.0, audio.probe_duration(chunk))]
+        else:
+            clips = [(0.0, len(chunk) / audio.SAMPLE_RATE)]
+        segments = []
+        for clip_start, clip_end in clips:
+            start = clip_start
+            while start < clip_end:
+                end = min(clip_end, start + self.segment_length)
+                segments.append(Segment(start, end, f" {self.speaker} line {start:.0f}", -0.25, None))
+                start = end
+        return segments, None
+
+# Speaker name, length in seconds, seconds between the starts of two bursts and burst length in seconds.
+# The quiet player barely speaks, like in a real session
+SPEAKERS = [
+    ("gm", 1.0, 20, 8),
+    ("fighter", 1.0, 45, 6),
+    ("wizard", 0.9, 90, 4),
+    ("quiet", 0.8, 600, 10),
+]
+
+def synthesize_session(folder, hours):
+    """One mp3 per speaker of tone and noise bursts between long stretches of silence, every speaker with its own length."""
+    os.makedirs(folder, exist_ok=True)
+    files = []
+    for name, length, period, burst in SPEAKERS:
+        duration = round(hours * 3600 * length)
+        expression = f"if(lt(mod(t\\,{period})\\,{burst})\\,0.4*sin(2*PI*(220+40*floor(t/{period}))*t)+0.05*(random(0)-0.5)\\,0)"
+        file_path = os.path.join(folder, f"{name}.mp3")
+        subprocess.run([
+            "ffmpeg", "-nostdin", "-v", "error", "-y", "-f", "lavfi", "-i", f"aevalsrc={expression}:s=16000:d={duration}",
+            "-ac", "1", "-b:a", "32k", file_path
+        ], check=True)
+        files.append(file_path)
+    return files
+
+def run_stage(results, name, audio_seconds, function):
+    start = time.perf_counter()
+    extra = function() or {}
+    wall = time.perf_counter() - start
+    rss = peak_rss_mb()
+    results[name] = {
+        "wall_seconds": round(wall, 3),
+        "peak_rss_mb": rss,
+        # Audio hours processed per hour of wall time
+        "throughput": round(audio_seconds / wall, 1) if wall > 0 else None,
+        **extra,
+    }
+    print(f"{name:<16} {wall:8.2f}s  rss {rss:7.1f}MB  {results[name]['throughput']}x realtime")
+
+def transcribe_files(files, folder, stream):
+    """Runs the files through transcript.transcribe_split or transcribe_stream like a folder run, then assembles their journals."""
+    os.makedirs(folder, exist_ok=True)
+    metrics = new_metrics(os.path.basename(folder))
+    segmenter = None
+    if not stream:
+        segmenter = transcript.new_segmenter()
+        for file_path in files:
+            base_name = os.path.splitext(os.path.basename(file_path))[0]
+            transcript.prefetch_split(segmenter, file_path, base_name, journal_dir(folder, base_name))
+    try:
+        for file_path in files:
+            base_name = os.path.splitext(os.path.basename(file_path))[0]
+            journal = journal_dir(folder, base_name)
+            transcript.model.speaker = base_name
+            if stream:
+                transcript.transcribe_stream(file_path, base_name, journal, file_metrics(metrics, base_name))
+            else:
+                transcript.transcribe_split(file_path, base_name, journal, file_metrics(metrics, base_name), segmenter)
+            assemble_journal(journal, os.path.join(folder, f"{base_name}{RECORD_EXTENSION}"))
+    finally:
+        if segmenter is not None:
+            segmenter.close()
+    # Written like a folder run writes it, so metrics that json can not serialize fail the benchmark
+    write_metrics(folder, metrics)
+    # The pipeline's own stage timings, summed over the speaker files
+    stages = {}
+    for section in metrics["files"].values():
+        for stage, seconds in section["stages"].items():
+            stages[stage] = round(stages.get(stage, 0.0) + seconds, 3)
+    return {"segments": metrics["totals"]["segments"], "chunks": metrics["totals"]["chunks"], "silent_chunks": metrics["totals"]["silent_chunks"], "stages": stages}
+
+def peak_folder_size(folder, stop, peak):
+    """Samples the bytes in folder until stop is set, peak[0] is the most seen at once."""
+    while not stop.wait(0.05):
+        size = 0
+        for entry in os.scandir(folder):
+            try:
+                size += entry.stat().st_size
+            except FileNotFoundError:
+                pass  # Released while scanning
+        peak[0] = max(peak[0], size)
+
+def benchmark(work_dir, hours, chunk_length):
+    session = os.path.join(work_dir, "session")
+    chunks_dir = os.path.join(work_dir, "chunks")
+    transcripts = os.path.join(work_dir, "transcripts")
+    polished = os.path.join(work_dir, "polished")
+    for folder in (chunks_dir, transcripts, polished):
+        os.makedirs(folder, exist_ok=True)
+
+    # The pipeline runs as it would with -l chunk_length, only the model is the stub
+    transcript.args = transcript.parse_args(["-l", str(chunk_length), "-q"])
+    transcript.args.workers = 1
+    transcript.tmpfiles = chunks_dir
+    transcript.CHUNK_LENGTH_SECONDS = chunk_length
+    transcript.model = StubModel()
+
+    print(f"Synthesizing a {hours} hour session with {len(SPEAKERS)} speakers")
+    files = synthesize_session(session, hours)
+    audio_seconds = sum(audio.probe_duration(file_path) for file_path in files)
+    records = []
+    results = {}
+
+    def split():
+        # The cut chunks waiting in the spool are the temporary disk use of the split mode
+        stop = threading.Event()
+        peak = [0]
+        sampler = threading.Thread(target=peak_folder_size, args=(chunks_dir, stop, peak), daemon=True)
+        sampler.start()
+        try:
+            result = transcribe_files(files, os.path.join(transcripts, "split"), stream=False)
+        finally:
+            stop.set()
+            sampler.join()
+        return {**result, "temp_disk_mb": round(peak[0] / 1024 / 1024, 1)}
+
+    def stream():
+        return transcribe_files(files, os.path.join(transcripts, "stream"), stream=True)
+
+    def merge_all():
+        stats = {}
+        records.extend(merge.merged_records(os.path.join(transcripts, "split"), stats=stats))
+        return {"records": len(records), "bleed_suppressed": stats.get("bleed", 0)}
+
+    def render_all():
+        outputs = {output_format: os.path.join(polished, f"session.{output_format}") for output_format in format.WRITERS}
+        return {"records": format.render(records, outputs, header="# Benchmark")}
+
+    print(f"Running stages over {seconds_to_hms(audio_seconds)} of audio")
+    run_stage(results, "split", audio_seconds, split)
+    run_stage(results, "stream", audio_seconds, stream)
+    run_stage(results, "merged_records", audio_seconds, merge_all)
+    run_stage(results, "render", audio_seconds, render_all)
+    return {"hours": hours, "chunk_length": chunk_length, "audio_seconds": round(audio_seconds, 1), "stages": results}
+
+def compare(results, baseline, tolerance):
+    """Print every stage against the baseline, returns the stages that got slower than the tolerance allows."""
+    regressions = []
+    print(f"\n{'stage':<16} {'baseline':>10} {'now':>10} {'change':>8}")
+    for name, stage in results["stages"].items():
+        old = baseline["stages"].get(name)
+        if not old:
+            print(f"{name:<16} {'-':>10} {stage['wall_seconds']:>9.2f}s")
+            continue
+        change = (stage["wall_seconds"] - old["wall_seconds"]) / old["wall_seconds"] if old["wall_seconds"] else 0
+        flag = ""
+        if change > tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<16} {old['wall_seconds']:>9.2f}s {stage['wall_seconds']:>9.2f}s {change:>+8.0%}{flag}")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="transcription benchmark", description="Benchmark the non-inference stages of the transcription pipeline on a synthesized session.")
+    parser.add_argument('--hours', type=float, default=1.0, help="Length of the synthesized session in hours")
+    parser.add_argument('-l', '--chunk_length', type=int, default=1800, help="Chunk length in seconds")
+    parser.add_argument('--work_dir', help="Folder for the synthesized session and outputs, a temporary folder by default")
+    parser.add_argument('--save', help="Save the results as a baseline json file")
+    parser.add_argument('--compare', help="Compare the results against a saved baseline json file")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed slowdown of a stage against the baseline, 0.2 is 20 percent")
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="transcript-benchmark-")
+    try:
+        results = benchmark(work_dir, args.hours, args.chunk_length)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=1)
+        print(f"Baseline saved to: {args.save}")
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("hours") != results["hours"] or baseline.get("chunk_length") != results["chunk_length"]:
+            print("Warning: the baseline was recorded with a different session length or chunk length")
+        if compare(results, baseline, args.tolerance):
+            raise SystemExit(1)
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+import shutil
+from segments import RECORD_EXTENSION
+import sources
+
+CACHE_FILE = "cache.json"
+
+
+def file_digest(file_path, block_size=1 << 20):
+    """Sha256 of the file content, read in blocks so large recordings are never loaded at once. A track inside a zip is hashed as it is decompressed."""
+    digest = hashlib.sha256()
+    with sources.open_source(file_path) as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def transcript_key(digest, settings: dict):
+    """Key of a speaker transcript, the audio content plus every setting that changes what the model produces."""
+    return hashlib.sha256(json.dumps({"audio": digest, **settings}, sort_keys=True).encode("utf-8")).hexdigest()
+
+def load_cache(folder):
+    """
+    The cache keeps two tables:
+    files maps an audio file name to its size, mtime and digest, so unchanged files are not hashed again (size and crc for tracks in a zip),
+    transcripts maps a transcript key to the speaker name whose transcript file holds it.
+    """
+    cache_path = os.path.join(folder, CACHE_FILE)
+    cache = {"files": {}, "transcripts": {}, "rendered": ""}
+    if os.path.isfile(cache_path):
+        try:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                cache.update(json.load(f))
+        except (ValueError, OSError) as e:
+            print(f"Ignoring unreadable cache {cache_path}. Reason: {e}")
+    return cache
+
+def save_cache(folder, cache):
+    # Written to a temporary file first so a crash never leaves a half written cache behind
+    cache_path = os.path.join(folder, CACHE_FILE)
+    with open(cache_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(cache, f, indent=1)
+    os.replace(cache_path + ".tmp", cache_path)
+
+def cached_digest(cache, folder_path, name):
+    """Digest of a recording in the folder, reusing the cached one while the name, size and mtime (or crc) are unchanged."""
+    file_path = os.path.join(folder_path, name)
+    identity = sources.source_identity(file_path)
+    entry = cache["files"].get(name)
+    if entry and {key: value for key, value in entry.items() if key != "digest"} == identity:
+        return entry["digest"]
+    digest = file_digest(file_path)
+    cache["files"][name] = {**identity, "digest": digest}
+    return digest
+
+def render_key(keys: dict, header: str, formats: list, merge_settings: dict = None):
+    """Key of the rendered outputs, changes whenever a speaker transcript, a speaker name, the header, the output formats or the merge settings change."""
+    return hashlib.sha256(json.dumps({"keys": keys, "header": header, "formats": sorted(formats), "merge": merge_settings}, sort_keys=True).encode("utf-8")).hexdigest()
+
+# Chunks of a speaker file are journaled under the transcript key until the whole file is done
+JOURNAL_DIR = "journal"
+
+def journal_dir(folder, key):
+    return os.path.join(folder, JOURNAL_DIR, key)
+
+def chunk_id(chunk_start):
+    """Chunks are identified by their start in whole milliseconds, so float offsets compare reliably."""
+    return round(chunk_start * 1000)
+
+def finished_chunks(journal):
+    """Ids of the chunks that were committed to the journal, leftover temporary files of a crash are ignored."""
+    if not os.path.isdir(journal):
+        return set()
+    return {int(name[:-len(RECORD_EXTENSION)]) for name in os.listdir(journal) if name.endswith(RECORD_EXTENSION)}
+
+def commit_chunk(journal, chunk_start, lines):
+    """
+    Atomically record the lines of one finished chunk, an empty list marks a silent chunk as done.
+    The lines go to a temporary file that is only renamed into place once it is flushed to disk,
+    so a crash half way through a chunk leaves no trace of it and the chunk is simply transcribed again.
+    """
+    os.makedirs(journal, exist_ok=True)
+    chunk_path = os.path.join(journal, f"{chunk_id(chunk_start):012d}{RECORD_EXTENSION}")
+    with open(chunk_path + ".tmp", "w", encoding="utf-8") as f:
+        f.writelines(lines)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(chunk_path + ".tmp", chunk_path)
+
+def assemble_journal(journal, output_file, keep=False):
+    """Write the journaled chunks in order into output_file and drop the journal, unless keep because more chunks are coming."""
+    with open(output_file + ".tmp", "w", encoding="utf-8") as output:
+        for chunk in sorted(finished_chunks(journal)):
+            with open(os.path.join(journal, f"{chunk:012d}{RECORD_EXTENSION}"), "r", encoding="utf-8") as f:
+                output.write(f.read())
+        output.flush()
+        os.fsync(output.fileno())
+    os.replace(output_file + ".tmp", output_file)
+    if not keep:
+        shutil.rmtree(journal, ignore_errors=True)
+
+def clean_journals(folder, keys):
+    """Remove every journal whose name is not in keys: of files that were removed or changed, or were transcribed with other settings or chunks."""
+    journals = os.path.join(folder, JOURNAL_DIR)
+    if not os.path.isdir(journals):
+        return
+    for key in os.listdir(journals):
+        if key not in keys:
+            shutil.rmtree(os.path.join(journals, key), ignore_errors=True)
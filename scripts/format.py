@@ -1,120 +1,156 @@
-import re
+import json
+from segments import record_text, seconds_to_hms, dump_record
 
 
-
-
-def parse_timestamp_to_seconds(timestamp):
-    """Convert a timestamp in HH:MM:SS format to total seconds."""
-    try:
-        h, m, s = map(int, timestamp.split(":"))
-        return h * 3600 + m * 60 + s
-    except ValueError:
-        return float('inf')  # Place invalid timestamps at the end
-
-def order_lines_by_timestamp(input_lines):
-    """Order lines by their first timestamp."""
-    def extract_start_time(line):
-        match = re.match(r"\[(.*?) - .*?\]", line)
-        return parse_timestamp_to_seconds(match.group(1)) if match else float('inf')
-    
-    return sorted(input_lines, key=extract_start_time)
-
-def merge_speaker_lines(input_lines,format:str =""):
-    # Process the lines as before, but after sorting them
-    input_lines = order_lines_by_timestamp(input_lines)
-    merged_lines = []
-    current_speaker = None
-    current_start = None
-    current_end = None
-    current_text = []
+class BlockWriter:
+    """Joins consecutive records of a speaker into one indented block under a header, the txt and md transcripts."""
     indent_level = 3  # Set a fixed column for indentation
 
-    last_line = ""
-    line_repeat_count = 0
-
-    for line in input_lines:
-        # Match lines in the format: [start - end] Speaker: Text
-        match = re.match(r"\[(.*?) - (.*?)\] (.*?): (.*)", line)
-        if not match:
-            continue
-
-        start, end, speaker, text = match.groups()
-        spkr = ""
-
-        if speaker != current_speaker:
+    def __init__(self, file, header="", format=""):
+        self.file = file
+        self.format = format
+        self.current_speaker = None
+        self.current_start = None
+        self.current_end = None
+        self.current_text = []
+        self.blocks = 0
+        file.write(header+"\n")
+
+    def write(self, record):
+        if record["speaker"] != self.current_speaker:
             # If speaker changes, finalize the current speaker's block
-            if current_speaker and current_text:
-                merged_lines.append(format_block(current_start, current_end, current_text, indent_level,format=format))
+            self.finish_block()
             # Reset for the new speaker
-            current_speaker = speaker
-            current_start = start
-            current_text = []
-            spkr = speaker
-            line_repeat_count = 0
-            current_text.append(f"{spkr}:")
-        else:
-            for i in range(len(speaker)): 
-                spkr = ""# + spkr
+            self.current_speaker = record["speaker"]
+            self.current_start = record["start"]
+            self.current_text = [f"{record['speaker']}:"]
 
         # Update the end time and add text
-        current_end = end
-        if last_line == text:
-            line_repeat_count += 1
-        else:
-            if line_repeat_count > 0:
-                current_text.append(f"{spkr}\t:")
-                current_text.append(f"{last_line} (x{line_repeat_count})")
-            current_text.append(f"{text}")
-            line_repeat_count = 0
-        last_line = text
-
-    # Finalize the last block
-    if current_speaker and current_text:
-        merged_lines.append(format_block(current_start, current_end, current_text, indent_level,format=format))
-
-    return merged_lines
+        self.current_end = record["end"]
+        self.current_text.append(record_text(record))
+
+    def finish_block(self):
+        if self.current_speaker and self.current_text:
+            if self.blocks > 0:
+                self.file.write("\n\n")
+            self.file.write(format_block(self.current_start, self.current_end, self.current_text, self.indent_level, format=self.format))
+            self.blocks += 1
+        self.current_text = []
+
+    def close(self):
+        # Finalize the last block
+        self.finish_block()
+
+def subtitle_time(seconds, separator=","):
+    milliseconds = round(seconds * 1000)
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}{separator}{milliseconds:03d}"
+
+class SrtWriter:
+    """One numbered cue per record, for lining the transcript up with the Craig recordings."""
+
+    def __init__(self, file, header="", format=""):
+        self.file = file
+        self.cues = 0
+
+    def write(self, record):
+        self.cues += 1
+        self.file.write(f"{self.cues}\n{subtitle_time(record['start'])} --> {subtitle_time(record['end'])}\n{record['speaker']}: {record_text(record).strip()}\n\n")
+
+    def close(self):
+        pass
+
+class VttWriter:
+    """WebVTT cues with the speaker as voice tag."""
+
+    def __init__(self, file, header="", format=""):
+        self.file = file
+        file.write("WEBVTT\n\n")
+
+    def write(self, record):
+        self.file.write(f"{subtitle_time(record['start'], '.')} --> {subtitle_time(record['end'], '.')}\n<v {record['speaker']}>{record_text(record).strip()}\n\n")
+
+    def close(self):
+        pass
+
+class JsonWriter:
+    """A single json document with the header and all records, for tooling. Records are written as they come in."""
+
+    def __init__(self, file, header="", format=""):
+        self.file = file
+        self.records = 0
+        file.write('{"header": ' + json.dumps(header, ensure_ascii=False) + ', "segments": [\n')
+
+    def write(self, record):
+        if self.records > 0:
+            self.file.write(",\n")
+        self.file.write(json.dumps(record, ensure_ascii=False))
+        self.records += 1
+
+    def close(self):
+        self.file.write("\n]}\n")
+
+class JsonlWriter:
+    """The merged records themselves, one per line."""
+
+    def __init__(self, file, header="", format=""):
+        self.file = file
+
+    def write(self, record):
+        self.file.write(dump_record(record))
+
+    def close(self):
+        pass
+
+# Output formats by name, a new format only needs a writer with write(record) and close()
+WRITERS = {
+    "txt": BlockWriter,
+    "md": BlockWriter,
+    "srt": SrtWriter,
+    "vtt": VttWriter,
+    "json": JsonWriter,
+    "jsonl": JsonlWriter,
+}
+
+def render(records, outputs: dict, header: str = ""):
+    """
+    Walk the merged records once and feed every output writer at the same time.
+    outputs maps a format name from WRITERS to the path it is written to, returns the number of records rendered.
+    """
+    files = []
+    writers = []
+    count = 0
+    try:
+        for format, path in outputs.items():
+            f = open(path, "w", encoding="utf-8")
+            files.append(f)
+            writers.append(WRITERS[format](f, header=header, format=format))
+        for record in records:
+            for writer in writers:
+                writer.write(record)
+            count += 1
+        for writer in writers:
+            writer.close()
+    finally:
+        for f in files:
+            f.close()
+    for path in outputs.values():
+        print(f"polished transcript saved to: {path}")
+    return count
 
 def format_block(start, end, texts, indent_level,format:str = ""):
     # Ensure that we don't try to format if the text is empty
     if not texts:
         return ""  # Prevent error if texts is empty
     # Create the formatted block with the start/end times and the first speaker line
+    start, end = seconds_to_hms(start), seconds_to_hms(end)
     if format == "md":
         block = [f"({start} - {end}) {texts[0]}"]
     else:
         block = [f"[{start} - {end}] {texts[0]}"]
     # Add each subsequent line, ensuring proper indentation
     block.extend(f"{' ' * indent_level}{line}" for line in texts[1:] if line.strip())  # Skip empty lines
-    
-    return "\n".join(block)
-
-def read_transcript_file(file_path):
-    try:
-        with open(file_path, "r", encoding="utf-8") as file:
-            return file.readlines()
-    except FileNotFoundError:
-        print(f"Error: File '{file_path}' not found.")
-        return []
-    except Exception as e:
-        print(f"Error reading file: {e}")
-        return []
-
-def format_with_header(merged_file:str, output_file:str,header:str="",format:str=""):
-    print(f"Reading from file: {merged_file}\n")
-    input_lines = read_transcript_file(merged_file)
-
-    if not input_lines:
-        print("No input lines found. Exiting.")
-        return
-
-    merged_output = merge_speaker_lines(input_lines,format=format)
-
-    # Save the merged output to a file
-    with open(output_file, "w", encoding="utf-8") as f:
-        f.write(header+"\n")
-        f.write("\n\n".join(merged_output))
-
-    print(f"polished transcript saved to: {output_file}")
-    print("\nPolished Output:\n")
-    print(f"{header}\n\n".join(merged_output))
 
+    return "\n".join(block)
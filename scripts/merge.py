@@ -1,90 +1,107 @@
-import re
+import heapq
 import os
-from collections import defaultdict
+import re
+from collections import Counter, deque
+from segments import RECORD_EXTENSION, read_records
+
+# Mic bleed puts what one player says on the tracks of the players near them as well, the copies start within this many seconds
+BLEED_WINDOW_SECONDS = 2.0
+# Share of the words of the longer text the shorter one must have for two records to count as the same sentence
+BLEED_SIMILARITY = 0.8
+# Shorter lines are never bleed, two players answering "Yes" or "Okay" at the same time both said it
+BLEED_MIN_WORDS = 3
 
 
-def remove_duplicate_messages(input_lines):
+def remove_duplicate_messages(records):
     """
-    Remove duplicate messages for each speaker, even if other speakers' messages intervene.
-    Consecutive duplicates are replaced with the format: "Message (xCount)".
+    Remove duplicate messages of one speaker, the speaker's own records are consecutive even if other speakers' messages intervene.
+    Consecutive duplicates are collapsed into the first one, which gets the end time of the last and a repeat count.
+    Runs as a generator so only the record being collapsed is held in memory.
     """
-    # Extract all unique speakers
-    speakers = set()
-    speaker_lines = defaultdict(list)
-
-    # Parse lines and group messages by speaker
-    for line in input_lines:
-        match = re.match(r"\[(.*?) - (.*?)\] (.*?): (.*)", line)
-        if match:
-            start, end, speaker, text = match.groups()
-            speakers.add(speaker)
-            speaker_lines[speaker].append((start, end, text))
-
-    # Process each speaker's messages
-    processed_lines = []
-    for speaker in speakers:
-        last_message = None
-        repeat_count = 0
-
-        for i, (start, end, text) in enumerate(speaker_lines[speaker]):
-            if text == last_message:
-                repeat_count += 1
-            else:
-                if repeat_count > 0:
-                    # Append the previous repeated message with the count
-                    processed_lines.append(f"[{speaker_lines[speaker][i - 1][0]} - {speaker_lines[speaker][i - 1][1]}] {speaker}: {last_message} (x{repeat_count + 1})")
-                # Append the current message
-                processed_lines.append(f"[{start} - {end}] {speaker}: {text}")
-                last_message = text
-                repeat_count = 0
-
-        # Handle trailing repeated message
-        if repeat_count > 0:
-            processed_lines.append(f"[{speaker_lines[speaker][-1][0]} - {speaker_lines[speaker][-1][1]}] {speaker}: {last_message} (x{repeat_count + 1})")
-
-    # Order the processed lines by timestamp
-    return processed_lines
-
-def parse_timestamp_to_seconds(timestamp):
-    """Convert a timestamp in HH:MM:SS format to total seconds."""
-    try:
-        h, m, s = map(int, timestamp.split(":"))
-        return h * 3600 + m * 60 + s
-    except ValueError:
-        return float('inf')  # Place invalid timestamps at the end
-
-def order_lines_by_timestamp(input_lines):
-    """Order lines by their first timestamp."""
-    def extract_start_time(line):
-        match = re.match(r"\[(.*?) - .*?\]", line)
-        return parse_timestamp_to_seconds(match.group(1)) if match else float('inf')
-
-    return sorted(input_lines, key=extract_start_time)
-
-def concatenate_transcripts(input_folder):
+    current = None
+    for record in records:
+        if current is not None and record["text"] == current["text"]:
+            current["repeat"] = current.get("repeat", 1) + 1
+            current["end"] = max(current["end"], record["end"])
+            continue
+        if current is not None:
+            yield current
+        current = record
+    if current is not None:
+        yield current
+
+def text_tokens(text) -> Counter:
+    return Counter(re.findall(r"[\w']+", text.lower()))
+
+def token_similarity(tokens: Counter, other: Counter) -> float:
+    """Shared words over the words of the longer text, casing and punctuation do not count."""
+    longest = max(sum(tokens.values()), sum(other.values()))
+    if longest == 0:
+        return 0.0
+    return sum((tokens & other).values()) / longest
+
+def confidence(record) -> float:
+    return record.get("avg_logprob", float("-inf"))
+
+def suppress_bleed(records, window=BLEED_WINDOW_SECONDS, similarity=BLEED_SIMILARITY, stats=None, min_words=BLEED_MIN_WORDS):
     """
-    Concatenate all files in the transcripts folder into a single merged file.
+    Drop the copies mic bleed leaves on other speakers' tracks from a time ordered record stream.
+    The records are swept in start order through a window of window seconds, each one is only compared with the records
+    of other speakers in the window that overlap it, so the work grows with the length of the session and not its square.
+    Of two copies the one the model was most confident about is kept, the bleed on a quiet track scores lower than the original.
+    Records of fewer than min_words words are kept as they are.
+    stats counts the dropped records under "bleed".
     """
-    transcript_files = []
-    for f in os.listdir(input_folder):
-        if os.path.isfile(os.path.join(input_folder, f)):
-            transcript_files.append(os.path.join(input_folder,f))
-    
-    merged_lines = []
-    for file_path in transcript_files:
-        with open(file_path, "r", encoding="utf-8") as file:
-            merged_lines.extend(file.readlines())
-
-   # with open(output_file, "w", encoding="utf-8") as output:
-    #    output.writelines(merged_lines)
-
-    return merged_lines
-
+    pending = deque()  # [record, tokens, dropped] in start order
+    for record in records:
+        while pending and pending[0][0]["start"] < record["start"] - window:
+            old, _, dropped = pending.popleft()
+            if not dropped:
+                yield old
+        entry = [record, text_tokens(record["text"]), False]
+        if sum(entry[1].values()) < min_words:
+            pending.append(entry)
+            continue
+        for other in pending:
+            other_record = other[0]
+            if other[2] or other_record["speaker"] == record["speaker"] or other_record["end"] < record["start"] or sum(other[1].values()) < min_words:
+                continue
+            if token_similarity(entry[1], other[1]) >= similarity:
+                # On a tie the earlier record stays
+                loser = entry if confidence(record) <= confidence(other_record) else other
+                loser[2] = True
+                if stats is not None:
+                    stats["bleed"] = stats.get("bleed", 0) + 1
+                if loser is entry:
+                    break
+        pending.append(entry)
+    for record, _, dropped in pending:
+        if not dropped:
+            yield record
+
+def speaker_transcripts(input_folder):
+    """
+    Paths of all speaker transcripts in the transcripts folder.
+    """
+    return sorted(
+        os.path.join(input_folder, f) for f in os.listdir(input_folder)
+        if f.endswith(RECORD_EXTENSION) and os.path.isfile(os.path.join(input_folder, f))
+    )
 
-def merge_folder(transcripts_folder:str,output_file):
+def merge_records(streams):
+    """
+    k-way merge of time ordered record streams into one time ordered stream.
+    Every speaker transcript is written in chunk order, so only the next record of each speaker is ever held in memory.
+    """
+    return heapq.merge(*streams, key=lambda record: record["start"])
 
-    merged_lines = order_lines_by_timestamp(concatenate_transcripts(transcripts_folder))
-    processed_lines = remove_duplicate_messages(merged_lines)
-    with open(output_file, "w", encoding="utf-8") as file:
-        file.writelines("\n".join(processed_lines))
 
+def merged_records(transcripts_folder:str, bleed_window=BLEED_WINDOW_SECONDS, stats=None):
+    """
+    The merged records of all speakers in the folder as one time ordered stream, ready to be rendered.
+    Mic bleed between the speakers is suppressed unless bleed_window is 0.
+    """
+    streams = [remove_duplicate_messages(read_records(path)) for path in speaker_transcripts(transcripts_folder)]
+    if bleed_window > 0:
+        return suppress_bleed(merge_records(streams), bleed_window, stats=stats)
+    return merge_records(streams)
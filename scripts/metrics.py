@@ -0,0 +1,173 @@
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+# Timings of a folder run, written next to metadata.txt so the stage worth fixing and the docker limits can be read off them.
+# Stages are wall seconds summed over the folder and per speaker file, every transcribed chunk gets its own entry
+METRICS_FILE = "metrics.json"
+
+# Chunks of one file are timed from several threads with -p
+lock = threading.Lock()
+
+
+def new_metrics(folder_name, **settings):
+    return {"folder": folder_name, **settings, "started": time.time(), "stages": {}, "files": {}}
+
+def file_metrics(metrics, base_name):
+    if metrics is None:
+        return None
+    with lock:
+        return metrics["files"].setdefault(base_name, {"audio_seconds": 0.0, "stages": {}, "chunks": []})
+
+# Every helper takes None for a section that is not being measured
+def add_time(section, stage, seconds):
+    if section is None:
+        return
+    with lock:
+        section["stages"][stage] = section["stages"].get(stage, 0.0) + seconds
+
+@contextmanager
+def timed(section, stage):
+    """Adds the wall time of the with block to the stage of a folder or file section, also when the block fails."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(section, stage, time.perf_counter() - start)
+
+def timed_iter(items, section, stage):
+    """Yield from items, adding the time spent waiting for each item to the stage, like decoding in a streamed file."""
+    items = iter(items)
+    try:
+        while True:
+            with timed(section, stage):
+                item = next(items, None)
+            if item is None:
+                return
+            yield item
+    finally:
+        # Stops a generator like stream_pcm right away when the consumer stops early
+        if hasattr(items, "close"):
+            items.close()
+
+def realtime_factor(seconds, audio_seconds):
+    # Processing seconds per second of audio, below 1 is faster than realtime
+    return round(seconds / audio_seconds, 4) if audio_seconds > 0 else None
+
+def add_chunk(section, start, audio_seconds, speech_seconds, inference_seconds, segments):
+    """One transcribed chunk, speech_seconds is None when the model's own vad decided what to transcribe."""
+    if section is None:
+        return
+    chunk = {
+        "start": round(start, 3),
+        "audio_seconds": round(audio_seconds, 3),
+        "speech_seconds": None if speech_seconds is None else round(speech_seconds, 3),
+        "inference_seconds": round(inference_seconds, 3),
+        "segments": segments,
+        # numpy comparisons give numpy.bool_, which json can not write
+        "silent": bool(speech_seconds == 0),
+        "rtf": realtime_factor(inference_seconds, audio_seconds),
+    }
+    with lock:
+        section["chunks"].append(chunk)
+        section["audio_seconds"] += audio_seconds
+        section["stages"]["inference"] = section["stages"].get("inference", 0.0) + inference_seconds
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux. It is the peak of the whole process since it started, in watch and live mode that
+    # covers every folder so far. Children are left out, ffmpeg and the workers inherit this process's peak when they are forked
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def summarize(metrics):
+    """Fill in the per file and folder totals from the chunks, safe to call again as the run goes on."""
+    with lock:
+        totals = {"audio_seconds": 0.0, "inference_seconds": 0.0, "segments": 0, "chunks": 0, "silent_chunks": 0}
+        metrics["stages"] = {stage: round(seconds, 3) for stage, seconds in metrics["stages"].items()}
+        for section in metrics["files"].values():
+            section["stages"] = {stage: round(seconds, 3) for stage, seconds in section["stages"].items()}
+            section["chunks"].sort(key=lambda chunk: chunk["start"])
+            section["segments"] = sum(chunk["segments"] for chunk in section["chunks"])
+            section["silent_chunks"] = sum(chunk["silent"] for chunk in section["chunks"])
+            inference = section["stages"].get("inference", 0.0)
+            section["rtf"] = realtime_factor(sum(section["stages"].values()), section["audio_seconds"])
+            section["inference_rtf"] = realtime_factor(inference, section["audio_seconds"])
+            section["audio_seconds"] = round(section["audio_seconds"], 3)
+            totals["audio_seconds"] += section["audio_seconds"]
+            totals["inference_seconds"] += inference
+            totals["segments"] += section["segments"]
+            totals["chunks"] += len(section["chunks"])
+            totals["silent_chunks"] += section["silent_chunks"]
+        metrics["runtime_seconds"] = round(time.time() - metrics["started"], 3)
+        totals["rtf"] = realtime_factor(metrics["runtime_seconds"], totals["audio_seconds"])
+        totals["inference_rtf"] = realtime_factor(totals["inference_seconds"], totals["audio_seconds"])
+        metrics["totals"] = totals
+        metrics["peak_rss_mb"] = peak_rss_mb()
+    return metrics
+
+def write_metrics(folder, metrics):
+    summarize(metrics)
+    metrics_path = os.path.join(folder, METRICS_FILE)
+    with lock:
+        text = json.dumps(metrics, indent=1)
+    with open(metrics_path + ".tmp", "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(metrics_path + ".tmp", metrics_path)
+    return metrics_path
+
+def label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+# name, help, value of a folder, value of a file section
+FOLDER_GAUGES = [
+    ("transcript_runtime_seconds", "Wall time of the folder run", lambda m: m["runtime_seconds"]),
+    ("transcript_audio_seconds", "Seconds of audio transcribed", lambda m: m["totals"]["audio_seconds"]),
+    ("transcript_realtime_factor", "Runtime per second of audio", lambda m: m["totals"]["rtf"]),
+    ("transcript_segments", "Segments produced", lambda m: m["totals"]["segments"]),
+    ("transcript_silent_chunks", "Chunks skipped as silent", lambda m: m["totals"]["silent_chunks"]),
+    ("transcript_bleed_suppressed", "Lines dropped from the merged transcript as mic bleed of another speaker", lambda m: m.get("bleed_suppressed")),
+    ("transcript_peak_rss_bytes", "Peak resident memory of the transcription process since it started, not just of this folder in watch and live mode", lambda m: m["peak_rss_mb"] * 1024 * 1024),
+]
+FILE_GAUGES = [
+    ("transcript_file_audio_seconds", "Seconds of audio of a speaker file", lambda f: f["audio_seconds"]),
+    ("transcript_file_realtime_factor", "Processing time per second of audio of a speaker file", lambda f: f["rtf"]),
+    ("transcript_file_segments", "Segments produced for a speaker file", lambda f: f["segments"]),
+    ("transcript_file_silent_chunks", "Chunks of a speaker file skipped as silent", lambda f: f["silent_chunks"]),
+]
+
+def write_prometheus(path, runs):
+    """
+    Write the metrics of every folder of the run in the Prometheus text format, for the node exporter textfile collector.
+    Written to a temporary file and renamed, the collector must never read half a file.
+    """
+    lines = []
+    def gauge(name, help):
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} gauge")
+
+    runs = [summarize(metrics) for metrics in runs]
+    for name, help, value in FOLDER_GAUGES:
+        gauge(name, help)
+        for metrics in runs:
+            if value(metrics) is not None:
+                lines.append(f'{name}{{folder="{label(metrics["folder"])}"}} {value(metrics)}')
+    gauge("transcript_stage_seconds", "Wall time of a pipeline stage, speaker file stages are summed per folder")
+    for metrics in runs:
+        stages = dict(metrics["stages"])
+        for section in metrics["files"].values():
+            for stage, seconds in section["stages"].items():
+                stages[stage] = stages.get(stage, 0.0) + seconds
+        for stage, seconds in sorted(stages.items()):
+            lines.append(f'transcript_stage_seconds{{folder="{label(metrics["folder"])}",stage="{label(stage)}"}} {round(seconds, 3)}')
+    for name, help, value in FILE_GAUGES:
+        gauge(name, help)
+        for metrics in runs:
+            for base_name, section in metrics["files"].items():
+                if value(section) is not None:
+                    lines.append(f'{name}{{folder="{label(metrics["folder"])}",speaker="{label(base_name)}"}} {value(section)}')
+
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(path + ".tmp", path)
@@ -0,0 +1,308 @@
+import os
+import re
+import argparse
+import sqlite3
+import time
+from contextlib import closing
+from urllib.parse import parse_qs
+from cache import load_cache
+from segments import RECORD_EXTENSION, read_records, seconds_to_hms, hms_to_seconds
+import audio
+import sources
+
+# Full text index over the merged transcripts of every session, an sqlite fts5 database in the transcripts folder.
+# A session is only indexed again when its render key changed, so finishing one session of a long campaign touches only that session
+INDEX_FILE = "search.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY, session TEXT NOT NULL, model TEXT NOT NULL, render_key TEXT NOT NULL, indexed REAL NOT NULL,
+    UNIQUE (session, model)
+);
+CREATE TABLE IF NOT EXISTS lines (
+    id INTEGER PRIMARY KEY, session_id INTEGER NOT NULL, speaker TEXT NOT NULL, start_time REAL NOT NULL, end_time REAL NOT NULL, text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS lines_session ON lines (session_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS lines_fts USING fts5 (text, content='lines', content_rowid='id', tokenize='porter unicode61');
+CREATE TRIGGER IF NOT EXISTS lines_insert AFTER INSERT ON lines BEGIN
+    INSERT INTO lines_fts (rowid, text) VALUES (new.id, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS lines_delete AFTER DELETE ON lines BEGIN
+    INSERT INTO lines_fts (lines_fts, rowid, text) VALUES ('delete', old.id, old.text);
+END;
+CREATE TABLE IF NOT EXISTS words (
+    line_id INTEGER NOT NULL, position INTEGER NOT NULL, start_ms INTEGER NOT NULL, end_ms INTEGER NOT NULL, word TEXT NOT NULL,
+    PRIMARY KEY (line_id, position)
+) WITHOUT ROWID;
+CREATE TRIGGER IF NOT EXISTS lines_delete_words AFTER DELETE ON lines BEGIN
+    DELETE FROM words WHERE line_id = old.id;
+END;
+"""
+
+# Word times of the sessions transcribed with --word_timestamps go into the words table, in whole milliseconds
+# and stored in line and word order, so the words of a hit are one short range read
+
+
+def open_index(index_path):
+    connection = sqlite3.connect(index_path, timeout=30)
+    # wal lets the status endpoint search while a finished session is being indexed
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+def index_session(index_path, session, model, merged_file, render_key):
+    """
+    Put the merged records of a session into the index, replacing what it held for the session before.
+    Returns the number of lines indexed, None when the session was already indexed with the same render key.
+    """
+    with closing(open_index(index_path)) as connection:
+        row = connection.execute("SELECT id, render_key FROM sessions WHERE session = ? AND model = ?", (session, model)).fetchone()
+        if row is not None and row[1] == render_key:
+            return None
+        # One transaction, a search sees either the old or the new lines of the session and never half of them
+        with connection:
+            if row is None:
+                session_id = connection.execute(
+                    "INSERT INTO sessions (session, model, render_key, indexed) VALUES (?, ?, ?, ?)", (session, model, render_key, time.time())
+                ).lastrowid
+            else:
+                session_id = row[0]
+                connection.execute("DELETE FROM lines WHERE session_id = ?", (session_id,))
+                connection.execute("UPDATE sessions SET render_key = ?, indexed = ? WHERE id = ?", (render_key, time.time(), session_id))
+            count = 0
+            for record in read_records(merged_file):
+                line_id = connection.execute(
+                    "INSERT INTO lines (session_id, speaker, start_time, end_time, text) VALUES (?, ?, ?, ?, ?)",
+                    (session_id, record["speaker"], record["start"], record["end"], record["text"])
+                ).lastrowid
+                if record.get("words"):
+                    connection.executemany(
+                        "INSERT INTO words (line_id, position, start_ms, end_ms, word) VALUES (?, ?, ?, ?, ?)",
+                        ((line_id, position, round(start * 1000), round(end * 1000), word) for position, (start, end, word) in enumerate(record["words"]))
+                    )
+                count += 1
+        return count
+
+def remove_session(connection, session_id):
+    with connection:
+        connection.execute("DELETE FROM lines WHERE session_id = ?", (session_id,))
+        connection.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+def update_index(transcripts_dir, index_path):
+    """
+    Bring the index in line with the transcripts folder: finished sessions that are new or changed are indexed,
+    sessions whose transcripts are gone are removed. For the sessions transcribed before there was an index.
+    """
+    found = set()
+    for session in sorted(os.listdir(transcripts_dir)):
+        session_dir = os.path.join(transcripts_dir, session)
+        if not os.path.isdir(session_dir):
+            continue
+        for model in sorted(os.listdir(session_dir)):
+            merged_file = os.path.join(session_dir, model, "polished", f"merged{RECORD_EXTENSION}")
+            render_key = load_cache(os.path.join(session_dir, model))["rendered"]
+            if not render_key or not os.path.isfile(merged_file):
+                continue
+            found.add((session, model))
+            count = index_session(index_path, session, model, merged_file, render_key)
+            if count is not None:
+                print(f"Indexed {count} lines of {session} ({model})")
+    with closing(open_index(index_path)) as connection:
+        for session_id, session, model in connection.execute("SELECT id, session, model FROM sessions").fetchall():
+            if (session, model) not in found:
+                remove_session(connection, session_id)
+                print(f"Removed {session} ({model}) from the index")
+
+def phrase(query):
+    # The whole query as one fts5 phrase, so words like AND or NEAR and quotes in it are just words
+    return '"' + query.replace('"', '""') + '"'
+
+def search(index_path, query, limit=20, session=None, speaker=None, raw=False):
+    """
+    Lines matching the query, best match first by bm25, as dicts with session, model, speaker, start, end and text.
+    The query is searched as a phrase unless raw, which passes fts5 query syntax straight through.
+    """
+    if not os.path.isfile(index_path):
+        return []
+    sql = """
+        SELECT sessions.session, sessions.model, lines.speaker, lines.start_time, lines.end_time, lines.text, lines.id
+        FROM lines_fts JOIN lines ON lines.id = lines_fts.rowid JOIN sessions ON sessions.id = lines.session_id
+        WHERE lines_fts MATCH ?"""
+    parameters = [query if raw else phrase(query)]
+    if session:
+        sql += " AND sessions.session = ?"
+        parameters.append(session)
+    if speaker:
+        sql += " AND lines.speaker = ?"
+        parameters.append(speaker)
+    sql += " ORDER BY bm25(lines_fts) LIMIT ?"
+    parameters.append(limit)
+    with closing(open_index(index_path)) as connection:
+        rows = connection.execute(sql, parameters).fetchall()
+    return [
+        {"session": row[0], "model": row[1], "speaker": row[2], "start": row[3], "end": row[4], "text": row[5], "line": row[6]}
+        for row in rows
+    ]
+
+# The header of a block copied out of the .txt transcript, [1:02:03 - 1:02:10] alice:, or the .md one, (1:02:03 - 1:02:10) alice:.
+# The text may follow on the same line, like the lines printed while transcribing, or indented on the lines below like in the files
+BLOCK_HEADER = re.compile(r"^[\[(](\d+:\d\d:\d\d) - (\d+:\d\d:\d\d)[\])] ([^:]+):(.*)$")
+REPEAT_SUFFIX = re.compile(r" \(x\d+\)$")
+
+def copied_block(query):
+    """(speaker, start, end, texts) of a block copied out of a rendered transcript, None when the query is not one."""
+    lines = [line.strip() for line in query.splitlines() if line.strip()]
+    header = BLOCK_HEADER.match(lines[0]) if lines else None
+    if not header:
+        return None
+    texts = [REPEAT_SUFFIX.sub("", text) for text in [header[4].strip(), *lines[1:]] if text]
+    return header[3].strip(), hms_to_seconds(header[1]), hms_to_seconds(header[2]), texts
+
+def tokens(text):
+    # Like the unicode61 tokenizer of the index, casing and punctuation do not count
+    return re.findall(r"\w+(?:'\w+)*", text.lower())
+
+def word_span(words, query_tokens):
+    """(start, end) in seconds of the first run of words that says the query tokens, None when the words do not have them in a row."""
+    flat = [(token, index) for index, (start_ms, end_ms, word) in enumerate(words) for token in tokens(word)]
+    count = len(query_tokens)
+    for position in range(len(flat) - count + 1):
+        if count and [token for token, _ in flat[position:position + count]] == query_tokens:
+            first, last = words[flat[position][1]], words[flat[position + count - 1][1]]
+            return first[0] / 1000, last[1] / 1000
+    return None
+
+def copied_lines(connection, block, session=None):
+    """
+    The lines a copied block stands for, one hit per session it is found in. The block times are rounded to the second,
+    so the lines are those of its speaker within them, narrowed down to the copied text lines when there are any.
+    """
+    speaker, start, end, texts = block
+    sql = """
+        SELECT sessions.session, sessions.model, lines.speaker, lines.start_time, lines.end_time, lines.text, lines.id
+        FROM lines JOIN sessions ON sessions.id = lines.session_id
+        WHERE lines.speaker = ? AND lines.start_time >= ? AND lines.end_time < ?"""
+    parameters = [speaker, start - 0.5, end + 0.5]
+    if session:
+        sql += " AND sessions.session = ?"
+        parameters.append(session)
+    sql += " ORDER BY sessions.session, lines.start_time"
+    copied = [tokens(text) for text in texts]
+    hits = {}
+    for row in connection.execute(sql, parameters).fetchall():
+        if copied and tokens(row[5]) not in copied:
+            continue
+        hit = hits.setdefault((row[0], row[1]), {"session": row[0], "model": row[1], "speaker": row[2], "start": row[3], "end": row[4], "text": "", "line": row[6]})
+        hit["end"] = max(hit["end"], row[4])
+        hit["last_line"] = row[6]
+        hit["text"] += row[5]
+    return list(hits.values())
+
+def block_span(connection, hit):
+    """(start, end) in seconds from the first word of the block's first line to the last word of its last line, None without word times."""
+    first = connection.execute("SELECT MIN(start_ms) FROM words WHERE line_id = ?", (hit["line"],)).fetchone()[0]
+    last = connection.execute("SELECT MAX(end_ms) FROM words WHERE line_id = ?", (hit["last_line"],)).fetchone()[0]
+    if first is None or last is None:
+        return None
+    return first / 1000, last / 1000
+
+def locate(index_path, query, limit=20, session=None, speaker=None, raw=False):
+    """
+    Where in the speaker recordings the query was said, as search hits with offset_start and offset_end in seconds of the speaker's track.
+    The query is a phrase, or a block copied out of a rendered transcript, its header with or without the text lines below it,
+    which finds the lines of that block.
+    exact is True when the offsets are those of the phrase's own words, False when they are of the whole line it is in,
+    because the session was transcribed without --word_timestamps or the words differ from the phrase, like a stemmed match.
+    A block is exact when its lines have word times, the offsets then run from its first word to its last.
+    """
+    if not os.path.isfile(index_path):
+        return []
+    block = copied_block(query)
+    with closing(open_index(index_path)) as connection:
+        if block:
+            hits = []
+            for hit in copied_lines(connection, block, session)[:limit]:
+                span = block_span(connection, hit)
+                offset_start, offset_end = span or (hit["start"], hit["end"])
+                hits.append({**hit, "offset_start": offset_start, "offset_end": offset_end, "exact": span is not None})
+            return hits
+        query_tokens = tokens(query)
+        hits = []
+        for hit in search(index_path, query, limit, session, speaker, raw):
+            words = connection.execute("SELECT start_ms, end_ms, word FROM words WHERE line_id = ? ORDER BY position", (hit["line"],)).fetchall()
+            span = None if raw else word_span(words, query_tokens)
+            offset_start, offset_end = span or (hit["start"], hit["end"])
+            hits.append({**hit, "offset_start": offset_start, "offset_end": offset_end, "exact": span is not None})
+        return hits
+
+def track_file(audio_dir, session, speaker):
+    """Recording of the speaker in the session folder of the audio folder, a track inside a zip included. None when it is gone."""
+    folder_path = os.path.join(audio_dir, session)
+    if not os.path.isdir(folder_path):
+        return None
+    for source in sources.list_sources(folder_path):
+        if sources.speaker_name(source) == speaker:
+            return os.path.join(folder_path, source)
+    return None
+
+def cut_hit(hit, track, out_dir, pad=0.5):
+    """Copy the located hit out of the speaker's track into out_dir with a single ffmpeg seek, padded on both sides. Returns the clip path."""
+    start = round(max(0.0, hit["offset_start"] - pad), 3)
+    extension = os.path.splitext(sources.split_member(track)[1] or track)[1]
+    clip_file = os.path.join(out_dir, f"{hit['session']}_{hit['speaker']}_{hit['offset_start']:.3f}{extension}")
+    audio.cut_clip(track, start, round(hit["offset_end"] + pad - start, 3), clip_file)
+    return clip_file
+
+def search_route(index_path, lookup=search):
+    """Route for watch.serve, /search?q=meet the lich&limit=20&session=...&speaker=...&raw=1, /locate takes the same with locate as the lookup"""
+    def route(query):
+        params = {key: values[-1] for key, values in parse_qs(query).items()}
+        if not params.get("q"):
+            raise ValueError("missing q")
+        return lookup(index_path, params["q"], int(params.get("limit", 20)), params.get("session"), params.get("speaker"), params.get("raw") == "1")
+    return route
+
+def format_hit(hit) -> str:
+    return f"{hit['session']} [{seconds_to_hms(hit['start'])} - {seconds_to_hms(hit['end'])}] {hit['speaker']}: {hit['text'].strip()}"
+
+def format_offset(hit, track) -> str:
+    precision = "word" if hit["exact"] else "line"
+    return f"{hit['session']} {hit['speaker']} {track or '(recording not found)'} {hit['offset_start']:.3f}-{hit['offset_end']:.3f}s ({precision}): {hit['text'].strip()}"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="transcript search", description="Search the merged transcripts of every session.")
+    parser.add_argument('query', nargs="?", help="Phrase to search for")
+    parser.add_argument('--index', default=os.path.join("/data/transcripts", INDEX_FILE), help="Path of the search index")
+    parser.add_argument('-n', '--limit', type=int, default=20, help="Number of hits to show")
+    parser.add_argument('--session', help="Only search this session folder")
+    parser.add_argument('--speaker', help="Only search the lines of this speaker")
+    parser.add_argument('--raw', action="store_true", help="Pass the query as fts5 query syntax, e.g. 'NEAR(lich meet, 5)', instead of searching it as a phrase")
+    parser.add_argument('--update', action="store_true", help="Index the finished sessions in the folder of the index that are new or changed first")
+    parser.add_argument('--locate', action="store_true", help="Print where in each speaker's recording the hits were said, to the word for sessions transcribed with --word_timestamps. The query can also be a block copied out of a transcript")
+    parser.add_argument('--clip', metavar="FOLDER", help="Copy every located hit out of its recording into this folder, implies --locate")
+    parser.add_argument('--pad', type=float, default=0.5, help="Seconds of audio kept before and after a clip")
+    parser.add_argument('--audio', default="/data/audio", help="Folder of the session recordings, for --locate and --clip")
+    args = parser.parse_args()
+
+    if args.update:
+        update_index(os.path.dirname(args.index), args.index)
+    if args.query:
+        started = time.perf_counter()
+        lookup = locate if args.locate or args.clip else search
+        try:
+            hits = lookup(args.index, args.query, args.limit, args.session, args.speaker, args.raw)
+        except sqlite3.OperationalError as e:
+            parser.error(f"bad query: {e}")
+        if args.clip:
+            os.makedirs(args.clip, exist_ok=True)
+        for hit in hits:
+            if lookup is search:
+                print(format_hit(hit))
+                continue
+            track = track_file(args.audio, hit["session"], hit["speaker"])
+            print(format_offset(hit, track))
+            if args.clip and track:
+                print(f"  saved {cut_hit(hit, track, args.clip, args.pad)}")
+        print(f"{len(hits)} hits in {(time.perf_counter() - started) * 1000:.1f}ms")
+    elif not args.update:
+        parser.error("give a query, --update or both")
@@ -0,0 +1,67 @@
+import json
+import re
+from datetime import timedelta
+
+# Speaker transcripts and the merged transcript are stored as one json record per line:
+# {"start": float, "end": float, "speaker": str, "text": str} plus optional "avg_logprob", "words" and "repeat"
+# words are [start, end, word] of every word, in seconds of the whole file like start and end
+RECORD_EXTENSION = ".jsonl"
+
+
+# offset moves the word times the same way start and end were moved, they come from the model relative to its input
+def segment_record(speaker, start, end, text, avg_logprob=None, words=None, offset=0.0):
+    record = {"start": round(start, 3), "end": round(end, 3), "speaker": speaker, "text": text}
+    if avg_logprob is not None:
+        record["avg_logprob"] = round(avg_logprob, 4)
+    if words:
+        record["words"] = [[round(word.start + offset, 3), round(word.end + offset, 3), word.word] for word in words]
+    return record
+
+def dump_record(record) -> str:
+    return json.dumps(record, ensure_ascii=False) + "\n"
+
+def read_records(file_path):
+    """Yield the records of a transcript file one at a time."""
+    with open(file_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def write_records(file_path, records):
+    with open(file_path, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(dump_record(record))
+
+# Helper function to format seconds to hh:mm:ss, rounded to the nearest second
+def seconds_to_hms(seconds):
+    # Round to the nearest second
+    seconds = round(seconds)
+    return str(timedelta(seconds=seconds))
+
+def hms_to_seconds(hms):
+    h, m, s = map(int, hms.split(":"))
+    return h * 3600 + m * 60 + s
+
+# A line of the speaker transcripts written before the records, [0:01:02 - 0:01:05] alice:  text
+LEGACY_LINE = re.compile(r"^\[(\d+:\d\d:\d\d) - (\d+:\d\d:\d\d)\] (.+?): (.*)$")
+
+def read_legacy_transcript(file_path):
+    """Records of a speaker transcript from before the records, the times are only whole seconds."""
+    records = []
+    with open(file_path, "r", encoding="utf-8") as f:
+        for line in f:
+            match = LEGACY_LINE.match(line.rstrip("\n"))
+            if match:
+                records.append(segment_record(match[3], hms_to_seconds(match[1]), hms_to_seconds(match[2]), match[4]))
+    # With -p the chunks were appended in the order they finished
+    records.sort(key=lambda record: record["start"])
+    return records
+
+def record_text(record) -> str:
+    if record.get("repeat", 1) > 1:
+        return f"{record['text']} (x{record['repeat']})"
+    return record["text"]
+
+def render_record(record) -> str:
+    """The classic human readable line, [h:mm:ss - h:mm:ss] speaker: text"""
+    return f"[{seconds_to_hms(record['start'])} - {seconds_to_hms(record['end'])}] {record['speaker']}: {record_text(record)}"
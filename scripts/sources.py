@@ -0,0 +1,142 @@
+import os
+import re
+import shutil
+import time
+import zipfile
+from contextlib import contextmanager
+
+# Speaker recordings are either loose audio files in the session folder or the tracks of a Craig export zip.
+# A track inside a zip is named "session.zip::1-alice.flac" and read straight out of the zip, it is never extracted
+AUDIO_EXTENSIONS = (".mp3", ".flac", ".ogg", ".opus", ".wav")
+ZIP_EXTENSION = ".zip"
+MEMBER_SEPARATOR = "::"
+
+
+def member_path(zip_path, member):
+    return f"{zip_path}{MEMBER_SEPARATOR}{member}"
+
+def split_member(source):
+    """(zip path, member name) of a track inside a zip, (source, None) for a plain file."""
+    zip_path, separator, member = source.partition(MEMBER_SEPARATOR)
+    if separator and zip_path.lower().endswith(ZIP_EXTENSION):
+        return zip_path, member
+    return source, None
+
+def is_audio(name):
+    return name.lower().endswith(AUDIO_EXTENSIONS)
+
+def list_sources(folder_path):
+    """Names of the speaker recordings of a session folder, loose audio files and the audio tracks of every zip in it."""
+    sources = []
+    for name in sorted(os.listdir(folder_path)):
+        file_path = os.path.join(folder_path, name)
+        if not os.path.isfile(file_path):
+            continue
+        if is_audio(name):
+            sources.append(name)
+        elif name.lower().endswith(ZIP_EXTENSION):
+            try:
+                with zipfile.ZipFile(file_path) as archive:
+                    sources.extend(member_path(name, info.filename) for info in archive.infolist() if not info.is_dir() and is_audio(info.filename))
+            except (zipfile.BadZipFile, OSError) as e:
+                # Most likely still being copied in
+                print(f"Skipping {file_path}, it is not a readable zip. Reason: {e}")
+    return sources
+
+def speaker_name(source):
+    """
+    Speaker a recording belongs to, the file name without extension. Craig numbers its tracks, 1-alice.flac is alice,
+    whether the track is still in the zip or was unpacked.
+    """
+    zip_path, member = split_member(source)
+    return re.sub(r"^\d+-", "", os.path.splitext(os.path.basename(member or source))[0])
+
+def duplicate_speakers(sources):
+    """Speakers with more than one recording, like alice.mp3 next to a Craig zip holding 1-alice.flac, mapped to those recordings."""
+    speakers = {}
+    for source in sources:
+        speakers.setdefault(speaker_name(source), []).append(source)
+    return {speaker: recordings for speaker, recordings in speakers.items() if len(recordings) > 1}
+
+def member_info(source):
+    zip_path, member = split_member(source)
+    with zipfile.ZipFile(zip_path) as archive:
+        return archive.getinfo(member)
+
+def source_identity(source):
+    """What the cached digest of a recording is checked against: size and mtime of a file, size and crc of a zip track."""
+    zip_path, member = split_member(source)
+    if member is None:
+        stat = os.stat(source)
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    # The crc comes from the zip directory, so a zip that was only copied or touched keeps its digests
+    info = member_info(source)
+    return {"size": info.file_size, "crc": info.CRC}
+
+def source_size(source):
+    zip_path, member = split_member(source)
+    if member is None:
+        return os.path.getsize(source)
+    return member_info(source).file_size
+
+@contextmanager
+def open_source(source):
+    """Binary reader of a recording, a zip track is decompressed as it is read."""
+    zip_path, member = split_member(source)
+    if member is None:
+        with open(source, "rb") as f:
+            yield f
+        return
+    with zipfile.ZipFile(zip_path) as archive, archive.open(member) as f:
+        yield f
+
+def feed(source, process, block_size=1 << 20):
+    """
+    Copy a recording into the stdin of an ffmpeg process, in a thread next to the one reading its output.
+    Stops quietly when ffmpeg stops reading early, a recording that can not be read kills ffmpeg so its caller sees the failure.
+    """
+    # Processes started with text=True only have a text stdin on top of the binary pipe
+    pipe = getattr(process.stdin, "buffer", process.stdin)
+    try:
+        with open_source(source) as f:
+            shutil.copyfileobj(f, pipe, block_size)
+    except BrokenPipeError:
+        pass  # ffmpeg was done, killed or stopped at -t
+    except Exception as e:
+        print(f"Error reading {source}. Reason: {e}")
+        process.kill()
+    finally:
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+
+def follow(source, process, ended, poll=1.0, block_size=1 << 20):
+    """
+    Feed a recording that is still being written into the stdin of an ffmpeg process like tail -f, waiting for it to grow,
+    until ended is set and everything written up to then is fed. Only works on plain files, a zip is never still being written.
+    """
+    pipe = getattr(process.stdin, "buffer", process.stdin)
+    try:
+        with open(source, "rb") as f:
+            while process.poll() is None:
+                # Checked before the read, so whatever was written before the end was set is still fed
+                done = ended.is_set()
+                block = f.read(block_size)
+                if block:
+                    pipe.write(block)
+                    pipe.flush()
+                elif done:
+                    break
+                else:
+                    time.sleep(poll)
+    except BrokenPipeError:
+        pass  # ffmpeg was killed
+    except Exception as e:
+        print(f"Error following {source}. Reason: {e}")
+        process.kill()
+    finally:
+        try:
+            pipe.close()
+        except OSError:
+            pass
@@ -5,15 +5,26 @@ umask 0000
 helpFunction()
 {
    echo ""
-   echo "Usage: $0  -b model_name -c compute_type -d device -p -q"
+   echo "Usage: $0  -b model_name -c compute_type -d device -p -q -S -B batch_size -w workers -f formats -P prometheus_file -t tune -W watch -L live -k words -D dry_run"
    echo -e "\t-b model_name, tiny, small, medium, large or distil-large-v3"
    echo -e "\t-c compute_type, int8, float16 or float32"
    echo -e "\t-d Device, cuda or cpu"
    echo -e "\t-p cpu threading option, paralell or serial"   
+   echo -e "\t-q quiet mode"
+   echo -e "\t-S stream decoded audio into the model instead of writing temporary chunk files"
+   echo -e "\t-B batch_size, batch the speech of all files in a folder, 0 or empty disables batching"
+   echo -e "\t-w workers, number of worker processes with their own model, splits the cpu cores between them"
+   echo -e "\t-f formats, comma separated output formats out of txt, md, srt, vtt and json, all of them by default"
+   echo -e "\t-t true, time worker, thread and compute type settings on a sample first and save the fastest for this and later runs"
+   echo -e "\t-W true, keep running with the model loaded and transcribe new session folders as they appear"
+   echo -e "\t-L true, keep running and transcribe sessions that are still being recorded as the audio comes in"
+   echo -e "\t-k true, keep the time of every word so search.py can find a phrase in the recordings to the word"
+   echo -e "\t-D true, only print what every folder needs, nothing is transcribed or changed"
+   echo -e "\t-P prometheus_file, also write the run metrics in the prometheus text format, e.g. into a node exporter textfile folder"
    exit 1 # Exit script after printing help
 }
 
-while getopts "b:c:d:p:q" opt
+while getopts "b:c:d:p:qSB:w:f:P:t:W:L:k:D:" opt
 do
    case "$opt" in
       b ) model_name="$OPTARG" ;;
@@ -21,6 +32,16 @@ do
       d ) device="$OPTARG" ;;
       p ) paralell=true ;;
       q ) quiet=true;;
+      S ) stream=true;;
+      B ) batch_size="$OPTARG" ;;
+      w ) workers="$OPTARG" ;;
+      f ) formats="$OPTARG" ;;
+      P ) prometheus="$OPTARG" ;;
+      t ) tune="$OPTARG" ;;
+      W ) watch="$OPTARG" ;;
+      L ) live="$OPTARG" ;;
+      k ) words="$OPTARG" ;;
+      D ) dry_run="$OPTARG" ;;
       ? ) helpFunction ;; # Print helpFunction in case parameter is non-existent
    esac
 done
@@ -38,6 +59,9 @@ echo "model name    : $model_name"
 echo "compute type  : $compute_type"
 echo "device        : $device"
 echo "paralell mode : $paralell"
+echo "stream mode   : $stream"
+echo "batch size    : $batch_size"
+echo "workers       : $workers"
 
 echo "audio files:"
 ls /data/audio
@@ -51,6 +75,13 @@ ls /root/.cache/huggingface/hub/
 echo "nvidia-smi info"
 nvidia-smi | grep NVIDIA
 
+# The ffmpeg packages are kept next to the scripts, so a recreated container installs them offline instead of running apt every start
+apt_cache=/data/scripts/.apt-cache
+if ! command -v ffmpeg >/dev/null 2>&1 && ls $apt_cache/*.deb >/dev/null 2>&1
+then
+   echo "installing ffmpeg from $apt_cache"
+   dpkg -i $apt_cache/*.deb > /dev/null 2>&1
+fi
 if ! command -v ffmpeg >/dev/null 2>&1
 then
    echo "ffmpeg could not be found"
@@ -58,26 +89,51 @@ then
    echo "updating repositories"
    apt update > /dev/null 2>&1
    echo "installing ffmpeg"
-   apt install -y ffmpeg > /dev/null 2>&1
+   mkdir -p $apt_cache/partial
+   apt-get install -y -o Dir::Cache::Archives=$apt_cache -o APT::Keep-Downloaded-Packages=true ffmpeg > /dev/null 2>&1
 
 fi
 
 
 echo "Transcribing $session_name"
+extra_args=""
 if [ "$paralell" = true ]; then
-   if [ "$quiet" = true ]; then
-      python3 /data/scripts/transcript.py -m $model_name -c $compute_type -d $device -p -q
-   else
-      python3 /data/scripts/transcript.py -m $model_name -c $compute_type -d $device -p 
-
-   fi
-else
-   if [ "$quiet" = true ]; then
-      python3 /data/scripts/transcript.py -m $model_name -c $compute_type -d $device -q
-   else
-      python3 /data/scripts/transcript.py -m $model_name -c $compute_type -d $device  
-
-   fi
+   extra_args="$extra_args -p"
+fi
+if [ "$quiet" = true ]; then
+   extra_args="$extra_args -q"
+fi
+if [ "$stream" = true ]; then
+   extra_args="$extra_args -S"
+fi
+if [ -n "$batch_size" ] && [ "$batch_size" != "0" ]; then
+   extra_args="$extra_args -B $batch_size"
+fi
+if [ -n "$workers" ] && [ "$workers" != "auto" ]; then
+   extra_args="$extra_args -w $workers"
+fi
+if [ -n "$formats" ]; then
+   extra_args="$extra_args -F $formats"
+fi
+if [ "$dry_run" = true ]; then
+   extra_args="$extra_args --plan"
+fi
+if [ "$watch" = true ]; then
+   extra_args="$extra_args -W"
+fi
+if [ "$live" = true ]; then
+   extra_args="$extra_args -L"
+fi
+if [ "$words" = true ]; then
+   extra_args="$extra_args --word_timestamps"
+fi
+if [ -n "$prometheus" ]; then
+   extra_args="$extra_args -P $prometheus"
+fi
+if [ "$tune" = true ]; then
+   echo "Tuning workers, threads and compute type"
+   python3 /data/scripts/transcript.py -m $model_name -c $compute_type -d $device -T
 fi
+python3 /data/scripts/transcript.py -m $model_name -c $compute_type -d $device $extra_args
 
 echo "Finished"
\ No newline at end of file
@@ -1,14 +1,25 @@
 import os, shutil
-import subprocess
-from datetime import timedelta
-from faster_whisper import WhisperModel
-#, BatchedInferencePipeline
 import argparse
 import time
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import multiprocessing
+import threading
+import math
 import merge
 import format
+import audio
+import tune
+import watch
+import search
+import sources
+from segments import RECORD_EXTENSION, segment_record, dump_record, render_record, read_records, write_records, seconds_to_hms, read_legacy_transcript
+from cache import CACHE_FILE, load_cache, save_cache, cached_digest, transcript_key, render_key
+from cache import JOURNAL_DIR, journal_dir, chunk_id, finished_chunks, commit_chunk, assemble_journal, clean_journals
+from metrics import new_metrics, file_metrics, add_time, timed, timed_iter, add_chunk, write_metrics, write_prometheus
+import numpy as np
 import re
+import bisect
+import ast
 
 def cleandir(folder: str):
     for filename in os.listdir(folder):
@@ -21,19 +32,6 @@ def cleandir(folder: str):
         except Exception as e:
             print('Failed to delete %s. Reason: %s' % (file_path, e))
 
-# Initialize the argument parser
-parser = argparse.ArgumentParser(prog="faster-whisper session transcription", description="Transcribe audio files and add a session title to the output file names.")
-#parser.add_argument('session_title', type=str, help="Title for the transcription session, which will be prefixed to the output file names.")
-parser.add_argument('-m', '--model')
-parser.add_argument('-d', '--device')
-parser.add_argument('-c', '--compute_type')
-parser.add_argument('-p', '--paralell_type', action="store_true", help="Enable quiet mode")
-parser.add_argument('-q', '--quiet', action="store_true", help="Enable quiet mode")
-parser.add_argument('-s', '--chunk_silence', action="store_false",help="Disables the checking if a chunk is silent.")
-parser.add_argument('-l', '--chunk_length', type=int, default=1800, help="Set the chunk length in seconds")
-
-args = parser.parse_args()
-
 # Path to the directory containing the audio files
 tmpfiles = "/tmpfiles"
 audio_dir = "/data/audio"
@@ -41,124 +39,640 @@ output_dir = f"/data/transcripts/"
 copy_dir = f"{output_dir}completed"
 #polish_dir = f"{output_dir}/polished"
 
-# Ensure the output directory exists
-os.makedirs(output_dir, exist_ok=True)
-os.makedirs(tmpfiles, exist_ok=True)
-os.makedirs(copy_dir, exist_ok=True)
+# Set by main, importing this module parses nothing and touches no folders, so planning, merging and formatting can be reused on their own
+args = None
+
+def parse_args(argv=None):
+    # Initialize the argument parser
+    parser = argparse.ArgumentParser(prog="faster-whisper session transcription", description="Transcribe audio files and add a session title to the output file names.")
+    #parser.add_argument('session_title', type=str, help="Title for the transcription session, which will be prefixed to the output file names.")
+    parser.add_argument('-m', '--model')
+    parser.add_argument('-d', '--device')
+    parser.add_argument('-c', '--compute_type', default="auto", help="Compute type of the model, auto takes the one found by --tune")
+    parser.add_argument('-p', '--paralell_type', action="store_true", help="Enable quiet mode")
+    parser.add_argument('-q', '--quiet', action="store_true", help="Enable quiet mode")
+    parser.add_argument('-s', '--chunk_silence', action="store_false",help="Disables the speech detection, whole chunks are transcribed with the model's own vad filter.")
+    parser.add_argument('-l', '--chunk_length', type=int, help="Set the chunk length in seconds, by default the longest that fits in the memory limit of the container or --memory_mb")
+    parser.add_argument('--memory_mb', type=int, help="Memory budget in megabytes the chunk length is worked out from, the container's memory limit by default")
+    parser.add_argument('--word_timestamps', action="store_true", help="Keep the time of every word, so search.py --locate and --clip find a phrase in the audio to the word")
+    parser.add_argument('-S', '--stream', action="store_true", help="Decode each file once and stream the audio into the model instead of writing temporary chunk files")
+    parser.add_argument('-F', '--formats', type=lambda value: [f.strip() for f in value.split(",") if f.strip()], default=["txt", "md", "srt", "vtt", "json"], help="Comma separated output formats out of txt, md, srt, vtt and json, all of them by default")
+    parser.add_argument('-w', '--workers', type=int, help="Number of worker processes, each with its own model, that transcribe the chunks of all folders. Can not be combined with -B. 1 unless --tune found more to be faster")
+    parser.add_argument('-B', '--batch_size', type=int, default=0, help="Transcribe the speech of all files in a folder in batches of this size, 0 disables batching. Always streams and ignores -p")
+    parser.add_argument('-t', '--threads', type=int, help="Number of threads sharing the model with -p, taken from --tune when not given")
+    parser.add_argument('--cpu_threads', type=int, help="cpu threads of every model, by default the cpus of the container are shared out evenly")
+    parser.add_argument('-T', '--tune', action="store_true", help="Time worker, thread and compute type settings on a short sample and save the fastest that fits in memory for later runs, instead of transcribing")
+    parser.add_argument('--tune_seconds', type=int, default=30, help="Length of the sample timed by --tune in seconds")
+    parser.add_argument('--spool_mb', type=int, default=audio.SPOOL_BYTES // 1024 // 1024, help="Megabytes of cut chunk files allowed to wait in the temporary folder, cutting pauses above it")
+    parser.add_argument('-W', '--watch', action="store_true", help="Keep running with the model loaded and transcribe session folders as they appear or change")
+    parser.add_argument('--settle', type=int, default=60, help="Seconds the files of a folder must stay unchanged before watch mode transcribes it")
+    parser.add_argument('--poll', type=int, default=30, help="Seconds between rescans of the audio folder in watch mode")
+    parser.add_argument('-L', '--live', action="store_true", help="Keep running and transcribe the recordings of sessions that are still being recorded as the audio comes in")
+    parser.add_argument('--live_window', type=int, default=60, help="Seconds of new audio transcribed at a time in live mode")
+    parser.add_argument('--live_end', type=int, default=300, help="Seconds without new audio after which live mode finishes a session")
+    parser.add_argument('--status_host', default="127.0.0.1", help="Address of the watch mode status endpoint")
+    parser.add_argument('--status_port', type=int, default=8765, help="Port of the watch mode status endpoint, 0 disables it")
+    parser.add_argument('--bleed_window', type=float, default=merge.BLEED_WINDOW_SECONDS, help="Seconds within which the same sentence on two speakers' tracks counts as mic bleed and only the most confident copy is kept, 0 keeps every copy")
+    parser.add_argument('-P', '--prometheus', help="Also write the metrics of the run in the Prometheus text format to this file, for the node exporter textfile collector")
+    parser.add_argument('--plan', action="store_true", help="Only print what every folder needs, nothing is transcribed, loaded or changed")
+
+    args = parser.parse_args(argv)
+    for output_format in args.formats:
+        if output_format not in ("txt", "md", "srt", "vtt", "json"):
+            parser.error(f"unknown output format {output_format}")
+    if (args.workers or 1) > 1 and args.batch_size > 0:
+        parser.error("-w and -B can not be combined, batching already runs all speakers through one model")
+    if args.live and (args.watch or args.batch_size > 0):
+        parser.error("-L can not be combined with -W or -B, live mode follows every recording with its own stream into one model")
+    return args
 
-# Clean any possible remenants of an old run
-cleandir(tmpfiles)
-#cleandir(output_dir)
-#cleandir(polish_dir)
+# The setting the last --tune found for this model, device and container limits fills in whatever was not given
+def apply_tuning(args):
+    tuning = None if args.tune else tune.load_tuning(output_dir, tune.tuning_key(args.model, args.device))
+    if tuning:
+        if args.workers is None and args.batch_size == 0:
+            args.workers = tuning["workers"]
+        if args.threads is None and tuning["threads"] > 1 and (args.workers or 1) == 1:
+            args.threads = tuning["threads"]
+            args.paralell_type = True
+        if args.cpu_threads is None:
+            args.cpu_threads = tuning["cpu_threads"]
+        if args.compute_type == "auto":
+            args.compute_type = tuning["compute_type"]
+    if args.workers is None:
+        args.workers = 1
+    if args.compute_type == "auto" and not args.tune:
+        args.compute_type = "default"
 
-# Initialize the Whisper model
-model = WhisperModel(args.model, device=args.device, compute_type=args.compute_type)  # Adjust device/computation type as needed
+# The Whisper model is loaded on first use, worker processes load their own.
+# faster_whisper itself is only imported then too, it takes seconds to import and runs without work never need it
+model = None
+batched_model = None
 #model sizes: tiny; base; small; medium; large
 #compute types: int8; float16; float32
 #devices: cpu - cpu; cuda - nvidia gpu, only newer ones with tenser cores get any real benefit.
 
-# Global variable for chunk length in seconds
-CHUNK_LENGTH_SECONDS = args.chunk_length  # 30 minutes by default
+model_lock = threading.Lock()
+# Seconds the last model load took, a worker reports it with its first chunk
+model_load_seconds = 0.0
+
+# Threads sharing the model, only more than one when -p runs chunks side by side in this process
+def model_workers() -> int:
+    if args.paralell_type and args.threads and args.workers == 1:
+        return args.threads
+    return 1
+
+# Chunks transcribed side by side with -p, the thread pools are capped to it and the memory budget counts every one of them
+def parallel_chunks() -> int:
+    if not args.paralell_type or args.workers > 1 or args.batch_size > 0:
+        return 1
+    return args.threads or min(4, tune.available_cpus())
+
+# Every model gets an even share of the container's cpus, so the models of all workers and threads never oversubscribe them
+def model_cpu_threads(processes=1) -> int:
+    if args.cpu_threads:
+        return args.cpu_threads
+    return max(1, tune.available_cpus() // (processes * model_workers()))
+
+def load_model(cpu_threads=None):
+    global model, model_load_seconds
+    if cpu_threads is None:
+        cpu_threads = model_cpu_threads()
+    with model_lock:
+        if model is None:
+            from faster_whisper import WhisperModel
+            started = time.perf_counter()
+            model = WhisperModel(args.model, device=args.device, compute_type=args.compute_type, cpu_threads=cpu_threads, num_workers=model_workers())  # Adjust device/computation type as needed
+            model_load_seconds = time.perf_counter() - started
+    return model
+
+def load_batched_model():
+    global batched_model
+    if batched_model is None:
+        from faster_whisper import BatchedInferencePipeline
+        batched_model = BatchedInferencePipeline(model=load_model())
+    return batched_model
+
+# Metrics of the last run of every folder worked on, for the prometheus file. Keyed by folder, a folder transcribed again
+# in watch or live mode replaces its old entry so the file never has two series of one folder
+run_metrics = {}
+
+# Global variable for chunk length in seconds, set by main from -l or the memory budget
+DEFAULT_CHUNK_LENGTH = 1800  # 30 minutes when there is no memory limit to go by
+CHUNK_LENGTH_SECONDS = DEFAULT_CHUNK_LENGTH
+
+def chunk_length() -> int:
+    """-l when given, otherwise the longest chunk that fits in the memory budget with the models of this run."""
+    if args.chunk_length:
+        return args.chunk_length
+    memory = args.memory_mb * 1024 * 1024 if args.memory_mb else tune.memory_limit()
+    # The chunk spool in /tmpfiles is a tmpfs and counts towards the container's memory
+    reserved = args.spool_mb * 1024 * 1024 if run_mode() == "split" else 0
+    target = tune.chunk_target(memory, args.model, args.device, args.compute_type, args.workers, parallel_chunks(), reserved)
+    if target is None:
+        return DEFAULT_CHUNK_LENGTH
+    print(f"Chunk length {target} seconds for a {memory / 1024 ** 3:.1f}GB memory budget")
+    return target
 
 def qprint(input):
     if args.quiet == False:
         print(input)
 
 
-# Helper function to format seconds to hh:mm:ss, rounded to the nearest second
-def seconds_to_hms(seconds):
-    # Round to the nearest second
-    seconds = round(seconds)
-    return str(timedelta(seconds=seconds))
-
-# Function checks if audio file (using path) is complately silent. Significantly speeds up dnd audio transcription due to the large sections of silence
-def is_completely_silent(file_path):
-    qprint("checking if silent")
-    command = [
-        "ffmpeg", "-i", file_path, "-af", "silencedetect=n=-35dB:d=1", "-f", "null", "-"
-    ]
-    result = subprocess.run(command, stderr=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
-    #qprint(result)
-    search_string = f"silence_duration: {CHUNK_LENGTH_SECONDS}"
-
-    if search_string in result.stderr:
-        return True  # Entire file is silent
-    return False  # Not completely silent
-
-# Helper function to split the audio file into smaller chunks using streaming
-def split_audio(input_file, base_name, chunk_length_seconds=1800):  # Default to 30 minutes (1800 seconds)
-    qprint("Splitting audio into chunks...")
-
-    # Run ffmpeg to get the total duration of the input file
-    result = subprocess.run(['ffmpeg', '-i', input_file],stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
-    # Extract the duration in seconds from ffmpeg's stderr output
-    duration_line = [line for line in result.stderr.splitlines() if "Duration" in line]
-    if not duration_line:
-        qprint("Error: Unable to determine the duration of the file.")
-        raise ChildProcessError(f"Error: Unable to determine the duration of the file {input_file}.\n {str(result.stderr)}")
+# chunk is either the path of a chunk file or the decoded samples of a chunk
+# clips are the speech ranges of the chunk relative to its start, None transcribes the whole chunk
+def transcribe_segments(chunk, cumulative_time, clips=None):
+    if clips is None:
+        segments, _ = load_model().transcribe(chunk, language="en", vad_filter=True, word_timestamps=args.word_timestamps)
+    elif not clips:
+        qprint(f"Chunk at {seconds_to_hms(cumulative_time)} is completely silent.")
         return []
-    
-    #if len(result.stderr) > 3:
-     #   raise ChildProcessError('Error in splitting files into chunks\n' + str(result.stderr))
-         
-    duration = duration_line[0].split()[1]
-    
-    # Clean up the duration string by removing commas and other non-numeric characters
-    duration = duration.replace(",", "").strip()
+    else:
+        clips = audio.pack_clips(clips)
+        qprint(f"Transcribing {len(clips)} speech ranges of chunk at {seconds_to_hms(cumulative_time)}")
+        segments, _ = load_model().transcribe(chunk, language="en", clip_timestamps=[t for clip in clips for t in clip], word_timestamps=args.word_timestamps)
+    return segments
+
+# The lines of a chunk are only committed to the journal once the whole chunk is transcribed
+# metrics is the section of the speaker file the chunk is timed in
+# length is the seconds of a chunk file, decoded chunks know their own
+def transcribe_chunk(chunk, base_name, cumulative_time, journal, clips=None, metrics=None, length=None):
+    started = time.perf_counter()
+    # The segments are generated lazily, the model only runs while they are turned into lines
+    segments = transcribe_segments(chunk, cumulative_time, clips)
+    lines = [record_line(chunk_record(base_name, segment, cumulative_time)) for segment in segments]
+    inference = time.perf_counter() - started
+    commit_chunk(journal, cumulative_time, lines)
+    if metrics is not None:
+        add_chunk(metrics, cumulative_time, chunk_seconds(chunk, length), clip_seconds(clips), inference, len(lines))
+
+def chunk_seconds(chunk, length=None):
+    if isinstance(chunk, str):
+        return length or CHUNK_LENGTH_SECONDS
+    return len(chunk) / audio.SAMPLE_RATE
+
+def clip_seconds(clips):
+    if clips is None:
+        return None
+    return float(sum(end - start for start, end in clips))
 
+# Record of a segment with its times moved from the chunk to the whole file
+def chunk_record(base_name, segment, cumulative_time):
+    return segment_record(base_name, segment.start + cumulative_time, segment.end + cumulative_time, segment.text, segment.avg_logprob, segment.words, cumulative_time)
+
+def record_line(record):
+    qprint(render_record(record))
+    return dump_record(record)
+
+def chunk_clips(speech, chunk_start, chunk_end=None):
+    if speech is None:
+        return None
+    return audio.clip_ranges(speech, chunk_start, chunk_end if chunk_end is not None else chunk_start + CHUNK_LENGTH_SECONDS)
+
+# Streamed chunks get their speech ranges from the samples already in memory
+def stream_clips(samples, metrics=None):
+    if not args.chunk_silence:
+        return None
+    with timed(metrics, "speech_detection"):
+        return audio.detect_speech_pcm(samples)
+
+# Start of the first chunk that is not journaled yet, a resumed stream seeks straight there
+def first_unfinished(done, length=None):
+    length = length or CHUNK_LENGTH_SECONDS
+    start = 0
+    while chunk_id(start) in done:
+        start += length
+    return start
+
+def resume_point(done, length=None):
+    start = first_unfinished(done, length)
+    if start > 0:
+        qprint(f"Resuming at {seconds_to_hms(start)}, {len(done)} chunks were already done")
+    return start
+
+def new_segmenter():
+    return audio.Segmenter(tmpfiles, CHUNK_LENGTH_SECONDS, args.spool_mb * 1024 * 1024, detect=args.chunk_silence)
+
+# Queues the file in the segmenter so its chunks are cut while the files before it are transcribed
+def prefetch_split(segmenter, file_path, base_name, journal):
+    segmenter.add(file_path, base_name, finished_chunks(journal))
+
+def transcribe_split(file_path, base_name, journal, metrics=None, segmenter=None):
+    """
+    Transcribes the chunk files the segmenter cuts for the file, each chunk is deleted as soon as it is done.
+    Without a segmenter that already has the file queued, one is made just for this file.
+    """
+    done = finished_chunks(journal)
+    if done:
+        qprint(f"Resuming, {len(done)} chunks were already done")
+    own_segmenter = segmenter is None
+    if own_segmenter:
+        segmenter = new_segmenter()
+        prefetch_split(segmenter, file_path, base_name, journal)
     try:
-        # Convert duration to hours, minutes, and seconds
-        h, m, s = map(float, duration.split(":"))
-        total_duration_seconds = int(h * 3600 + m * 60 + s)
-    except ValueError as e:
-        qprint(f"Error: Failed to parse duration '{duration}'. {e}")
-        return []
+        # One silence detection pass over the whole file, the chunks are cut in its silences and only transcribe their speech ranges
+        qprint("Waiting for the speech detection" if args.chunk_silence else "Waiting for the first chunk")
+        with timed(metrics, "speech_detection"):
+            speech = segmenter.speech(file_path)
 
-    qprint(f"Total duration: {total_duration_seconds} seconds")
+        # The chunks come in as the segmenter cuts them, waiting on it counts as splitting
+        chunks = timed_iter(segmenter.chunks(file_path), metrics, "split")
+        if args.paralell_type == True:
+            qprint("printed lines will be out of order before formatting")
+            with ThreadPoolExecutor(max_workers=parallel_chunks()) as executor:
+                futures = []
+                for start_time, end_time, chunk_file in chunks:
+                    future = executor.submit(transcribe_chunk, chunk_file, base_name, start_time, journal, chunk_clips(speech, start_time, end_time), metrics, end_time - start_time)
+                    future.add_done_callback(lambda _, chunk_file=chunk_file: segmenter.release(chunk_file))
+                    futures.append(future)
 
+                # Wait for all threads to complete
+                for future in futures:
+                    future.result()
+        else:
+            # Process each chunk individually
+            for start_time, end_time, chunk_file in chunks:
+                qprint(f"Transcribing chunk: {chunk_file}")
 
-    # Generate the chunk filenames and use ffmpeg to extract each segment
-    chunks = []
-    for start_time in range(0, total_duration_seconds, chunk_length_seconds):
-        chunk_file = os.path.join(tmpfiles, f"{base_name}_chunk_{start_time}.mp3")
+                # Transcribe the audio chunk
+                transcribe_chunk(chunk_file, base_name, start_time, journal, chunk_clips(speech, start_time, end_time), metrics, end_time - start_time)
+                segmenter.release(chunk_file)
+                qprint(f"Deleted temporary chunk file: {chunk_file}")
+    finally:
+        if own_segmenter:
+            segmenter.close()
 
-        # Use ffmpeg to split the file: seek to start_time and extract chunk_length_seconds duration
-        subprocess.run([ 
-            'ffmpeg', '-ss', str(start_time), '-i', input_file,
-            '-t', str(chunk_length_seconds), '-acodec', 'copy', '-y', chunk_file
-        ],stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
-        
-        chunks.append(chunk_file)
+# Streams decoded audio from one ffmpeg process per file straight into the model, no temporary chunk files are written
+def transcribe_stream(file_path, base_name, journal, metrics=None):
+    qprint("Streaming audio into the model...")
+    done = finished_chunks(journal)
+    # Time spent waiting on ffmpeg for the next chunk counts as decoding
+    chunks = timed_iter(audio.stream_pcm(file_path, CHUNK_LENGTH_SECONDS, start=resume_point(done)), metrics, "decode")
+    if args.paralell_type == True:
+        qprint("printed lines will be out of order before formatting")
+        # Only as many decoded chunks are in flight as the memory budget counted with
+        window = parallel_chunks()
+        with ThreadPoolExecutor(max_workers=window) as executor:
+            futures = []
+            for offset, samples in chunks:
+                if chunk_id(offset) in done:
+                    continue
+                if len(futures) >= window:
+                    futures.pop(0).result()
+                futures.append(executor.submit(transcribe_chunk, samples, base_name, offset, journal, stream_clips(samples, metrics), metrics))
+            for future in futures:
+                future.result()
+    else:
+        for offset, samples in chunks:
+            if chunk_id(offset) in done:
+                continue
+            qprint(f"Transcribing chunk at {seconds_to_hms(offset)}")
+            transcribe_chunk(samples, base_name, offset, journal, stream_clips(samples, metrics), metrics)
 
-    return chunks
+# Longest clip handed to the batched pipeline, whisper works on 30 second windows
+BATCH_CLIP_SECONDS = 30
 
-def transcribe_chunk(chunk_file, base_name, cumulative_time, output_file):
-    if args.chunk_silence:
-        qprint(f"Checking if chunk {chunk_file} is silent")
-        if is_completely_silent(chunk_file):
-            qprint(f"Chunk {chunk_file} is completely silent.")
-            return
+def transcribe_folder_batched(folder_path, files, journals, metrics=None):
+    """
+    Transcribe all files of a folder with one BatchedInferencePipeline.
+    The speech clips of every file are packed back to back into a shared buffer along with a table
+    remembering which speaker, chunk and original time each clip came from, so a batch can mix clips from several speakers.
+    The buffer is flushed every CHUNK_LENGTH_SECONDS of packed speech to keep memory bounded,
+    a flush always holds whole chunks so each of them is committed to its speaker's journal afterwards.
+    The inference time of a flush is shared out over its chunks by their seconds of speech.
+    """
+    packed = []  # sample arrays of the packed clips
+    table = []  # (packed start, packed end, base name, chunk start, original start) per clip
+    packed_chunks = []  # (base name, chunk start) of every chunk in the buffer, silent ones included
+    chunk_lengths = {}  # (audio seconds, speech seconds) of every chunk in the buffer
+    packed_length = 0.0
 
-    segments, _ = model.transcribe(chunk_file, language="en", vad_filter=True)
-    with open(output_file, "a", encoding="utf-8") as f:
-        for segment in segments:
-            start = segment.start + cumulative_time
-            end = segment.end + cumulative_time
-            text = segment.text
-
-            start_time = seconds_to_hms(start)
-            end_time = seconds_to_hms(end)
-            line = f"[{start_time} - {end_time}] {base_name}: {text}\n"
-            f.write(line)
-            if not args.quiet:
-                qprint(f"[{start_time} - {end_time}] {base_name}: {text}")
-
-# Process each .mp3 file in the directory and transcribe it
-def folders_to_txt(dir_path :str):
-    for fold_name in os.listdir(dir_path):
-        if os.path.isdir(os.path.join(dir_path,fold_name)):
-            stat = folder_to_txt(os.path.join(dir_path,fold_name),fold_name)
-            print(f"Folder {fold_name} done with status {stat}")
+    def flush():
+        nonlocal packed, table, packed_chunks, chunk_lengths, packed_length
+        lines = {chunk: [] for chunk in packed_chunks}
+        started = time.perf_counter()
+        if table:
+            qprint(f"Transcribing batch of {len(table)} clips ({seconds_to_hms(packed_length)} of speech)")
+            starts = [clip[0] for clip in table]
+            segments, _ = load_batched_model().transcribe(
+                np.concatenate(packed), language="en", batch_size=args.batch_size, vad_filter=False, word_timestamps=args.word_timestamps,
+                clip_timestamps=[{"start": clip[0], "end": clip[1]} for clip in table]
+            )
+            for segment in segments:
+                # Segments never cross clips, so the clip holding the segment middle maps it back to its speaker and time
+                middle = (segment.start + segment.end) / 2
+                clip_start, clip_end, base_name, chunk_start, original_start = table[max(0, bisect.bisect_right(starts, middle) - 1)]
+                start = original_start + (segment.start - clip_start)
+                end = original_start + (min(segment.end, clip_end) - clip_start)
+                record = segment_record(base_name, start, end, segment.text, segment.avg_logprob, segment.words, original_start - clip_start)
+                lines[(base_name, chunk_start)].append(record_line(record))
+        inference = time.perf_counter() - started
+        for (base_name, chunk_start), chunk_lines in lines.items():
+            commit_chunk(journals[base_name], chunk_start, chunk_lines)
+            audio_seconds, speech_seconds = chunk_lengths[(base_name, chunk_start)]
+            share = speech_seconds / packed_length if packed_length > 0 else 0.0
+            add_chunk(file_metrics(metrics, base_name), chunk_start, audio_seconds, speech_seconds, inference * share, len(chunk_lines))
+        packed, table, packed_chunks, chunk_lengths, packed_length = [], [], [], {}, 0.0
+
+    for file_name in files:
+        base_name = sources.speaker_name(file_name)
+        qprint(f"Packing speech of file: {file_name}")
+        done = finished_chunks(journals[base_name])
+        section = file_metrics(metrics, base_name)
+        chunks = audio.stream_pcm(os.path.join(folder_path, file_name), CHUNK_LENGTH_SECONDS, start=resume_point(done))
+        for offset, samples in timed_iter(chunks, section, "decode"):
+            if chunk_id(offset) in done:
+                continue
+            packed_chunks.append((base_name, offset))
+            clips = stream_clips(samples, section)
+            if clips is None:
+                clips = [(0.0, len(samples) / audio.SAMPLE_RATE)]
+            chunk_lengths[(base_name, offset)] = (len(samples) / audio.SAMPLE_RATE, clip_seconds(clips))
+            # Packed like a single chunk's clips, only a range longer than a clip is cut into pieces
+            for clip_start, clip_end in audio.pack_clips(clips, BATCH_CLIP_SECONDS):
+                while clip_start < clip_end:
+                    piece_end = min(clip_end, clip_start + BATCH_CLIP_SECONDS)
+                    # Copied so the packed buffer does not keep the whole decoded chunk alive
+                    piece = samples[int(clip_start * audio.SAMPLE_RATE):int(piece_end * audio.SAMPLE_RATE)].copy()
+                    if len(piece) > 0:
+                        piece_length = len(piece) / audio.SAMPLE_RATE
+                        table.append((packed_length, packed_length + piece_length, base_name, offset, offset + clip_start))
+                        packed.append(piece)
+                        packed_length += piece_length
+                    clip_start = piece_end
+            if packed_length >= CHUNK_LENGTH_SECONDS:
+                flush()
+    flush()
+
+# Process the recordings of every session folder in the directory and transcribe them
+# planned maps folder names to the jobs plan_folders made for them, so their recordings are not hashed a second time
+def folders_to_txt(dir_path :str, planned=None):
+    if planned is None:
+        planned = dict.fromkeys(session_folders(dir_path))
+    if args.workers > 1:
+        schedule_folders(dir_path, planned)
+        return
+    for fold_name, job in planned.items():
+        stat = folder_to_txt(os.path.join(dir_path,fold_name),fold_name, job)
+        print(f"Folder {fold_name} done with status {stat}")
+
+def session_folders(dir_path: str) -> list:
+    return [fold_name for fold_name in sorted(os.listdir(dir_path)) if os.path.isdir(os.path.join(dir_path,fold_name))]
+
+def plan_folders(dir_path: str) -> dict:
+    """
+    Works out what every session folder needs before the model is loaded or anything is changed,
+    prints it and returns the plans of the folders that have work by folder name.
+    """
+    pending = {}
+    for fold_name in session_folders(dir_path):
+        job = plan_folder(os.path.join(dir_path,fold_name),fold_name)
+        print(f"{fold_name}: {describe_plan(job)}")
+        if not job["up_to_date"]:
+            pending[fold_name] = job
+    if pending:
+        print(f"{len(pending)} of {len(session_folders(dir_path))} folders need work")
+    else:
+        print("Nothing to do, every folder is up to date")
+    return pending
+
+def describe_plan(job) -> str:
+    if job["duplicates"]:
+        return "error, " + duplicates_message(job)
+    if job["up_to_date"]:
+        return "up to date"
+    steps = []
+    if job["transcribe"]:
+        size = sum(sources.source_size(os.path.join(job["folder_path"], file_name)) for file_name in job["transcribe"])
+        steps.append(f"transcribe {len(job['transcribe'])} of {len(job['files'])} files ({size / 1024 ** 2:.0f}MB): {', '.join(job['transcribe'])}")
+        resumed = [file_name for file_name in job["transcribe"] if finished_chunks(speaker_journal(job, sources.speaker_name(file_name)))]
+        if resumed:
+            steps.append(f"resume {', '.join(resumed)} from the journal")
+    if job["legacy"]:
+        steps.append("convert the transcripts of an earlier version for " + ", ".join(job["legacy"]))
+    if job["renames"]:
+        steps.append("reuse transcripts for " + ", ".join(f"{base_name} (was {cached_name})" for base_name, cached_name in job["renames"].items()))
+    steps.append("merge and render " + ", ".join(output_paths(job)))
+    return "; ".join(steps)
+
+def watch_folders(dir_path: str):
+    """
+    Daemon mode: the model is loaded once and stays warm while the audio folder is watched,
+    a session folder is transcribed as soon as its recordings stopped changing for --settle seconds.
+    Folders that are already done are only checked against the cache, like in a normal run.
+    """
+    watcher = watch.make_watcher()
+    tracker = watch.SessionTracker(args.settle, sources.AUDIO_EXTENSIONS + (sources.ZIP_EXTENSION,))
+    status = watch.Status(watcher=watcher.kind, model=args.model, compute_type=args.compute_type, device=args.device)
+    server = None
+    if args.status_port:
+        server = watch.serve(args.status_host, args.status_port, {
+            "/": lambda query: status.snapshot(),
+            "/status": lambda query: status.snapshot(),
+            "/search": search.search_route(os.path.join(output_dir, search.INDEX_FILE)),
+            "/locate": search.search_route(os.path.join(output_dir, search.INDEX_FILE), search.locate),
+        })
+        print(f"Status on http://{args.status_host}:{args.status_port}/status, search on /search?q=... and /locate?q=...")
+    status.update(state="loading model")
+    if args.batch_size > 0:
+        load_batched_model()
+    else:
+        load_model()
+    print(f"Watching {dir_path} ({watcher.kind}) for new sessions")
+    try:
+        while True:
+            watcher.watch(dir_path)
+            for fold_name in os.listdir(dir_path):
+                if os.path.isdir(os.path.join(dir_path, fold_name)):
+                    try:
+                        watcher.watch(os.path.join(dir_path, fold_name))
+                    except OSError:
+                        continue  # Removed or renamed since the listing, the next scan sees it
+            ready = tracker.scan(dir_path)
+            status.update(state="transcribing" if ready else "idle", queue=[name for name, _ in ready])
+            for index, (fold_name, state) in enumerate(ready):
+                status.update(current=fold_name, queue=[name for name, _ in ready[index + 1:]])
+                try:
+                    stat = folder_to_txt(os.path.join(dir_path, fold_name), fold_name)
+                except Exception as e:
+                    print(f"Error in folder {fold_name}. Reason: {e}")
+                    stat = "Error"
+                # Marked done even on errors, the folder is only tried again once its recordings change
+                tracker.mark_done(fold_name, state)
+                status.finish(fold_name, stat)
+                print(f"Folder {fold_name} done with status {stat}")
+            if ready:
+                continue  # New files may have come in while transcribing
+            status.update(state="idle", queue=[])
+            # Wakes up early on inotify events, the timeout lets settling folders become ready
+            watcher.wait(min(args.poll, max(1, args.settle)))
+    finally:
+        watcher.close()
+        if server is not None:
+            server.shutdown()
+
+# Windows of a recording that is still being written, the audio has no digest to key them by until the session ends.
+# The window length is in the name, a restart with another --live_window starts the recording over instead of resuming on the wrong grid
+def live_journal(job, base_name):
+    return journal_dir(job["outfolder"], f"live-{base_name}-{args.live_window}")
+
+def start_live(folder_path: str, folder_name: str) -> dict:
+    job = new_job(folder_path, folder_name)
+    os.makedirs(job["polish_dir"], exist_ok=True)
+    os.makedirs(os.path.join(copy_dir,job["model_name"]), exist_ok=True)
+    # Transcripts of speakers whose recordings are gone are dropped, those of the recordings are sorted out as they are followed or kept
+    speakers = {sources.speaker_name(file_name) for file_name in sources.list_sources(folder_path)}
+    for name in os.listdir(job["outfolder"]):
+        stem, extension = os.path.splitext(name)
+        if extension == ".tmp" or (extension == RECORD_EXTENSION and stem not in speakers):
+            os.remove(os.path.join(job["outfolder"], name))
+    journals = os.path.join(job["outfolder"], JOURNAL_DIR)
+    if os.path.isdir(journals):
+        current = {os.path.basename(live_journal(job, speaker)) for speaker in speakers}
+        for name in os.listdir(journals):
+            if name.startswith("live-") and name not in current:
+                shutil.rmtree(os.path.join(journals, name), ignore_errors=True)
+    run_metrics[job["folder_name"]] = job["metrics"]
+    live = {"job": job, "cache": load_cache(job["outfolder"]), "ended": threading.Event(), "threads": {}, "kept": set(), "skipped": set(), "errors": [], "changed": False}
+    job_meta(job, "Live")
+    follow_recordings(live)
+    return live
+
+def growing(live, file_name) -> bool:
+    return time.time() - os.path.getmtime(os.path.join(live["job"]["folder_path"], file_name)) < args.live_end
+
+def finished_track(live, file_name) -> bool:
+    """A recording that stopped growing and whose transcript is cached, like a track that was already done before a late one was added."""
+    if growing(live, file_name):
+        return False
+    job = live["job"]
+    base_name = sources.speaker_name(file_name)
+    with timed(job["metrics"], "hash"):
+        key = transcript_key(cached_digest(live["cache"], job["folder_path"], file_name), transcript_settings())
+    return live["cache"]["transcripts"].get(key) == base_name and os.path.isfile(os.path.join(job["outfolder"], f"{base_name}{RECORD_EXTENSION}"))
+
+# Every recording that is not finished gets its own follower thread, players that join late show up as new files
+def follow_recordings(live):
+    job = live["job"]
+    for file_name in sources.list_sources(job["folder_path"]):
+        # A zip is a finished export and is left to a normal run
+        if file_name in live["threads"] or sources.split_member(file_name)[1] is not None:
+            continue
+        if file_name in live["kept"]:
+            if not growing(live, file_name):
+                continue
+            # Recording again into a finished track, its cached transcript no longer covers it
+            live["kept"].discard(file_name)
+        elif finished_track(live, file_name):
+            qprint(f"Keeping the cached transcript of {file_name}")
+            live["kept"].add(file_name)
+            continue
+        # A second recording of a speaker would write into the same journal
+        base_name = sources.speaker_name(file_name)
+        followed = next((name for name in [*live["threads"], *live["kept"]] if sources.speaker_name(name) == base_name), None)
+        if followed is not None:
+            if file_name not in live["skipped"]:
+                print(f"Not following {file_name}, {followed} already is speaker {base_name}")
+                live["skipped"].add(file_name)
+            continue
+        qprint(f"Following {file_name}")
+        transcript = os.path.join(job["outfolder"], f"{base_name}{RECORD_EXTENSION}")
+        if os.path.isfile(transcript):
+            os.remove(transcript)
+        job["audiofiles"].append(file_name)
+        live["threads"][file_name] = threading.Thread(target=follow_speaker, args=(live, file_name), daemon=True)
+        live["threads"][file_name].start()
+
+# Transcribes every window of a growing recording as soon as its audio is written, the timestamps carry on from window to window
+def follow_speaker(live, file_name):
+    job = live["job"]
+    base_name = sources.speaker_name(file_name)
+    journal = live_journal(job, base_name)
+    section = file_metrics(job["metrics"], base_name)
+    try:
+        start = resume_point(finished_chunks(journal), args.live_window)
+        chunks = audio.stream_pcm(os.path.join(job["folder_path"], file_name), args.live_window, start=start, follow=live["ended"])
+        for offset, samples in timed_iter(chunks, section, "decode"):
+            transcribe_chunk(samples, base_name, offset, journal, stream_clips(samples, section), section)
+            live["changed"] = True
+    except Exception as e:
+        print(f"Error in following {file_name} in {job['folder_path']}. Reason: {e}")
+        live["errors"].append(f"{file_name}: {e}")
+
+def render_live(live):
+    """Writes the transcript so far of every speaker and renders the merged transcript, the journals are kept for the windows still to come."""
+    job = live["job"]
+    live["changed"] = False
+    for file_name in list(live["threads"]):
+        base_name = sources.speaker_name(file_name)
+        if os.path.isdir(live_journal(job, base_name)):
+            assemble_journal(live_journal(job, base_name), os.path.join(job["outfolder"], f"{base_name}{RECORD_EXTENSION}"), keep=True)
+    with timed(job["metrics"], "merge_render"):
+        format.render(merge.merged_records(job["outfolder"], args.bleed_window), output_paths(job), header=read_header(job["folder_path"]))
+
+def finish_live(live) -> str:
+    """
+    The recordings stopped growing: the followers transcribe what is left after their last window and the session is finished
+    like a normal run. The transcripts are cached under the digests of the final recordings, so a later run finds the folder done.
+    Tracks that were kept keep their cached transcripts.
+    """
+    job = live["job"]
+    live["ended"].set()
+    for thread in live["threads"].values():
+        thread.join()
+    if live["errors"]:
+        job_meta(job, "Error in live transcription", "Error info: \n" + "\n".join(live["errors"]))
+        return "Error"
+    job["files"] = [*live["kept"], *live["threads"]]
+    cache = live["cache"]
+    job["keys"] = file_keys(job, cache)
+    cache["transcripts"] = {job["keys"][sources.speaker_name(file_name)]: sources.speaker_name(file_name) for file_name in live["kept"]}
+    for file_name in live["threads"]:
+        base_name = sources.speaker_name(file_name)
+        assemble_journal(live_journal(job, base_name), os.path.join(job["outfolder"], f"{base_name}{RECORD_EXTENSION}"))
+        cache["transcripts"][job["keys"][base_name]] = base_name
+    job["cache"] = cache
+    save_cache(job["outfolder"], cache)
+    job["render_key"] = render_key(job["keys"], read_header(job["folder_path"]), args.formats, merge_settings())
+    return finish_folder(job)
+
+def live_folders(dir_path: str):
+    """
+    Live mode: session folders whose recordings are growing are transcribed while they are being recorded,
+    --live_window seconds at a time as the audio comes in, and their merged transcript is rendered again after new windows.
+    Once a session's recordings did not grow for --live_end seconds only its last window is left to do.
+    Folders that are not being recorded are left to a normal or watch mode run.
+    """
+    tracker = watch.SessionTracker(args.live_end, sources.AUDIO_EXTENSIONS)
+    sessions = {}
+    load_model()
+    print(f"Following the recordings in {dir_path}, a session ends after {args.live_end} seconds without new audio")
+    while True:
+        now = time.time()
+        ended = tracker.scan(dir_path, now)
+        for fold_name in tracker.changing(now):
+            if fold_name not in sessions:
+                print(f"Session {fold_name} is being recorded, transcribing it live")
+                sessions[fold_name] = start_live(os.path.join(dir_path, fold_name), fold_name)
+            else:
+                follow_recordings(sessions[fold_name])
+        for fold_name, state in ended:
+            # Folders that were already finished when live mode started end up here too, they are left alone
+            tracker.mark_done(fold_name, state)
+            if fold_name in sessions:
+                try:
+                    stat = finish_live(sessions.pop(fold_name))
+                except Exception as e:
+                    print(f"Error in finishing {fold_name}. Reason: {e}")
+                    stat = "Error"
+                print(f"Session {fold_name} done with status {stat}")
+        for fold_name, live in sessions.items():
+            if live["changed"]:
+                try:
+                    render_live(live)
+                except Exception as e:
+                    print(f"Error in rendering the live transcript of {fold_name}. Reason: {e}")
+        time.sleep(min(args.poll, args.live_window))
 
 def update_meta(folder_path: str, title, status,model,compute,device,audiofiles,start_time,error = ""):
     end_time = time.time()
@@ -183,133 +697,544 @@ completion at           = {time.ctime(end_time)}
     with open(meta_path, "w",encoding="utf8") as f:
         f.writelines(meta)
 
-def check_meta(fold_path: str, title, status,model,compute,device,audiofiles) -> bool:
-    qprint("checking metadata")
-    meta_path = os.path.join(fold_path,"metadata.txt")
-    if os.path.exists(meta_path) is False:
-        return False
-    with open(meta_path,"r") as f:
-        meta = (f.read()).split("\n")[:5]
-    meta_cur = f"""Session title           = {title}
-Status                  = {status}
-faster-whisper model    = {model}
-compute-type            = {compute}
-device                  = {device}
-audiofiles              = {[f"{a} " for a in audiofiles ]}
-""".split("\n")[:5]
-    #print("existing:\n",meta,"current:\n",meta_cur)
-    if meta == meta_cur:
-        return True
-    else:
-        return False
+# Everything besides the audio that changes a transcript, the device is left out on purpose
+def transcript_settings() -> dict:
+    settings = {
+        "model": args.model,
+        "compute_type": args.compute_type,
+        # Sizing chunks by memory keeps the key of the old default, so a new host does not transcribe everything again
+        "chunk_length": args.chunk_length or DEFAULT_CHUNK_LENGTH,
+        "speech_detection": args.chunk_silence,
+        "silence_threshold_db": audio.SILENCE_THRESHOLD_DB,
+        "min_silence": audio.MIN_SILENCE_SECONDS,
+        "speech_padding": audio.SPEECH_PADDING_SECONDS,
+        "batched": args.batch_size > 0,
+    }
+    # Only in the key when on, so the transcripts made before it existed stay cached
+    if args.word_timestamps:
+        settings["word_timestamps"] = True
+    return settings
 
+# Everything besides the speaker transcripts that changes the merged transcript
+def merge_settings() -> dict:
+    return {"bleed_window": args.bleed_window, "bleed_similarity": merge.BLEED_SIMILARITY, "bleed_min_words": merge.BLEED_MIN_WORDS}
 
-def folder_to_txt(folder_path: str, folder_name: str) -> str: 
-    start_time = time.time()
-    MODEL_NAME = args.model.replace("/","-")
-    COMPUTE_TYPE = args.compute_type
-    DEVICE = args.device
-    AUDIOFILE_NAMES = []
-    outfolder = os.path.join(output_dir,folder_name,MODEL_NAME)
-    polish_dir = os.path.join(outfolder,"polished")
-    os.makedirs(outfolder, exist_ok=True)
-    os.makedirs(polish_dir, exist_ok=True) 
-    def meta_update(status,error = "", files = AUDIOFILE_NAMES):
-        update_meta(folder_path=polish_dir,title=folder_name,audiofiles=files,compute=COMPUTE_TYPE,device=DEVICE,start_time=start_time,error=error,status=status,model=MODEL_NAME)
-
-    print("Transcribing: ",folder_path)
-    _files = os.listdir(folder_path)
-    files = []
-    for file_name in _files:
-        if file_name.endswith(".mp3"):
-            files.append(file_name)
-    transcription_needed = True
-    if check_meta(polish_dir,folder_name,"Completed",MODEL_NAME,COMPUTE_TYPE,DEVICE,files) is True:
-        print ("Folder ", folder_name,"Has already been transcribed with same paramaters")
-        #print("metadata is equal")
-        transcription_needed = False
+def read_header(folder_path: str) -> str:
+    headerfile = os.path.join(folder_path,"header.txt")
+    header = ""
+    if os.path.isfile(headerfile):
+        with open(headerfile, "r") as f:
+            header = f.read()
+    return header
+
+# Swaps the speaker name of a transcript, used when an audio file was only renamed
+def rename_speaker(records, new_name: str):
+    for record in records:
+        record["speaker"] = new_name
+    return records
+
+def new_job(folder_path: str, folder_name: str) -> dict:
+    """The paths and metrics of a session folder, what every kind of run of the folder starts from."""
+    job = {
+        "folder_path": folder_path,
+        "folder_name": folder_name,
+        "start_time": time.time(),
+        "model_name": args.model.replace("/","-"),
+        "audiofiles": [],
+        "error": "",
+        "metrics": new_metrics(folder_name, model=args.model, compute_type=args.compute_type, device=args.device, mode=run_mode(),
+                               workers=args.workers, threads=model_workers(), cpu_threads=model_cpu_threads(args.workers)),
+    }
+    outfolder = os.path.join(output_dir,folder_name,job["model_name"])
+    job["outfolder"] = outfolder
+    job["polish_dir"] = os.path.join(outfolder,"polished")
+    return job
+
+def read_meta(polish_dir: str) -> dict:
+    """The fields of a folder's metadata.txt by name, empty when there is none."""
+    meta = {}
+    meta_path = os.path.join(polish_dir, "metadata.txt")
+    if os.path.isfile(meta_path):
+        with open(meta_path, "r", encoding="utf-8") as f:
+            for line in f:
+                name, separator, value = line.partition("=")
+                if separator:
+                    meta[name.strip()] = value.strip()
+    return meta
+
+def legacy_transcripts(job) -> dict:
+    """
+    Speaker transcripts left as .txt by a version from before the cache, by speaker, for a folder it completed with this model and compute type.
+    They are converted to records instead of transcribed again. Only recordings listed in its metadata.txt count, that is all it checked back then.
+    """
+    if os.path.isfile(os.path.join(job["outfolder"], CACHE_FILE)):
+        return {}
+    meta = read_meta(job["polish_dir"])
+    if meta.get("Status") != "Completed" or meta.get("faster-whisper model") != job["model_name"] or meta.get("compute-type") != args.compute_type:
+        return {}
+    try:
+        listed = {name.strip() for name in ast.literal_eval(meta.get("audiofiles", "[]"))}
+    except (ValueError, SyntaxError):
+        return {}
+    legacy = {}
+    for file_name in job["files"]:
+        # The old transcripts were named after the whole file name, Craig's track number included
+        transcript = os.path.join(job["outfolder"], f"{os.path.splitext(file_name)[0]}.txt")
+        if file_name in listed and os.path.isfile(transcript):
+            legacy[sources.speaker_name(file_name)] = transcript
+    return legacy
+
+def file_keys(job, cache) -> dict:
+    """Transcript key of every speaker file of the job, cached digests of removed files are dropped."""
+    cache["files"] = {name: entry for name, entry in cache["files"].items() if name in job["files"]}
+    settings = transcript_settings()
+    keys = {}
+    with timed(job["metrics"], "hash"):
+        for file_name in job["files"]:
+            digest = cached_digest(cache, job["folder_path"], file_name)
+            keys[sources.speaker_name(file_name)] = transcript_key(digest, settings)
+    return keys
+
+def plan_folder(folder_path: str, folder_name: str) -> dict:
+    """
+    Collects the output paths and audio files of a session folder and works out which speaker files need transcribing.
+    Every speaker transcript is cached under a key made from the audio content and the transcription settings,
+    so a renamed file only has its transcript renamed and only new or changed files are transcribed again.
+    Only reads, nothing is written until folder_job acts on the plan.
+    """
+    job = new_job(folder_path, folder_name)
+    outfolder = job["outfolder"]
+
+    # Loose recordings and the tracks of Craig zips, which are read out of the zip and never extracted
+    job["files"] = sources.list_sources(folder_path)
+    # Two recordings of one speaker would share a journal and a transcript, the folder is refused until one of them is removed
+    job["duplicates"] = sources.duplicate_speakers(job["files"])
+    if job["duplicates"]:
+        job.update(transcribe=[], renames={}, up_to_date=False)
+        return job
+    cache = load_cache(outfolder)
+    known_files = dict(cache["files"])
+    keys = file_keys(job, cache)
+    legacy = legacy_transcripts(job)
+
+    kept = {}
+    renames = {}
+    job["transcribe"] = []
+    job["legacy"] = {}
+    for file_name in job["files"]:
+        base_name = sources.speaker_name(file_name)
+        cached_name = cache["transcripts"].get(keys[base_name])
+        if cached_name is not None and os.path.isfile(os.path.join(outfolder, f"{cached_name}{RECORD_EXTENSION}")):
+            if cached_name == base_name:
+                kept[keys[base_name]] = base_name
+            else:
+                renames[base_name] = cached_name
+        elif base_name in legacy:
+            job["legacy"][base_name] = legacy[base_name]
+        else:
+            job["transcribe"].append(file_name)
+
+    job["cache"] = cache
+    job["digests_changed"] = cache["files"] != known_files
+    job["keys"] = keys
+    job["kept"] = kept
+    job["renames"] = renames
+    job["render_key"] = render_key(keys, read_header(folder_path), args.formats, merge_settings())
+    job["up_to_date"] = not job["transcribe"] and not renames and not job["legacy"] and cache["rendered"] == job["render_key"] and all(os.path.isfile(path) for path in output_paths(job).values())
+    return job
+
+def duplicates_message(job) -> str:
+    return "; ".join(f"{' and '.join(recordings)} are the same speaker {speaker}" for speaker, recordings in job["duplicates"].items()) + ", remove or rename all but one of them"
+
+def folder_job(folder_path: str, folder_name: str, job=None) -> dict:
+    """
+    Plans the folder, unless job is the plan plan_folders already made, and gets its output folder ready for the work:
+    renamed transcripts are reused and stale ones removed.
+    """
+    print("Checking: ",folder_path)
+    if job is None:
+        job = plan_folder(folder_path, folder_name)
     else:
-        cleandir(outfolder)
+        # The run of the folder starts now, not when every folder was planned
+        job["start_time"] = job["metrics"]["started"] = time.time()
+    if job["duplicates"]:
+        job["error"] = duplicates_message(job)
+        print(f"Error in {folder_path}: {job['error']}")
+        os.makedirs(job["polish_dir"], exist_ok=True)
+        job_meta(job, "Error in the recordings", f"Error info: \n{job['error']}", files=job["files"])
+        return job
+    outfolder = job["outfolder"]
+    cache = job["cache"]
+    keys = job["keys"]
+    kept = job["kept"]
+    renames = job["renames"]
+    if job["up_to_date"]:
+        # Digests of touched but unchanged files are kept so they are not hashed again
+        if job["digests_changed"]:
+            save_cache(outfolder, cache)
+        print ("Folder ", folder_name,"Has already been transcribed with same paramaters")
+        return job
     os.makedirs(outfolder, exist_ok=True)
-    os.makedirs(polish_dir, exist_ok=True)
+    os.makedirs(job["polish_dir"], exist_ok=True)
 
-    meta_update("Started")
-    if transcription_needed == True:
-        for file_name in files:
-            AUDIOFILE_NAMES.append(file_name)
-            file_path = os.path.join(folder_path, file_name)
-            qprint(f"Processing file: {file_path}")
+    # Renamed transcripts are read before anything is removed or written, so swapped names can not overwrite each other
+    renamed = {}
+    for base_name, cached_name in renames.items():
+        renamed[base_name] = rename_speaker(list(read_records(os.path.join(outfolder, f"{cached_name}{RECORD_EXTENSION}"))), base_name)
+    converted = {base_name: rename_speaker(read_legacy_transcript(transcript), base_name) for base_name, transcript in job["legacy"].items()}
+    # Transcripts of removed or changed files are thrown away, the journals of unfinished files are kept to resume from
+    for name in os.listdir(outfolder):
+        stem, extension = os.path.splitext(name)
+        if extension == ".tmp" or (extension == RECORD_EXTENSION and stem not in kept.values()):
+            os.remove(os.path.join(outfolder, name))
+        elif extension == ".txt" and os.path.join(outfolder, name) not in job["legacy"].values():
+            print(f"Keeping {os.path.join(outfolder, name)}, a transcript of an earlier version that does not match the recordings or settings. Remove it once the new transcript is checked")
+    clean_journals(outfolder, {journal_name(key) for key in keys.values()})
+    for base_name, records in renamed.items():
+        qprint(f"Reusing the transcript of {renames[base_name]} for {base_name}")
+        write_records(os.path.join(outfolder, f"{base_name}{RECORD_EXTENSION}"), records)
+        kept[keys[base_name]] = base_name
+    for base_name, records in converted.items():
+        qprint(f"Converting the transcript of an earlier version for {base_name}")
+        write_records(os.path.join(outfolder, f"{base_name}{RECORD_EXTENSION}"), records)
+        os.remove(job["legacy"][base_name])
+        kept[keys[base_name]] = base_name
+    cache["transcripts"] = kept
+    save_cache(outfolder, cache)
 
-            # Remove the .mp3 extension from the file name
-            base_name = os.path.splitext(file_name)[0]
-            meta_update("Transcribing "+ file_name)
+    run_metrics[job["folder_name"]] = job["metrics"]
+    job_meta(job, "Started")
+    return job
 
-            try:
-                # Split the audio file into chunks (5-minute segments by default)
-                chunks = split_audio(file_path, base_name, CHUNK_LENGTH_SECONDS)
-                qprint(f"Split the audio into {len(chunks)} chunks.")
-
-                # Track the cumulative time for the entire file
-                cumulative_time = 0
-
-                # Prepare the output file for the entire audio file
-                output_file = os.path.join(outfolder, f"{base_name}.txt")
-
-                if args.paralell_type == True:
-                    qprint("printed lines will be out of order before formatting")
-                    with ThreadPoolExecutor() as executor:
-                        futures = []
-                        for chunk_file in chunks:
-                            futures.append(executor.submit(transcribe_chunk, chunk_file, base_name, cumulative_time, output_file))
-                            cumulative_time += CHUNK_LENGTH_SECONDS
-
-                        # Wait for all threads to complete
-                        for future in futures:
-                            future.result()
-                else:
-                # with open(output_file, "w", encoding="utf-8") as f:
-                        # Process each chunk individually
-                        for chunk_file in chunks:
-                            qprint(f"Transcribing chunk: {chunk_file}")
-
-                            # Transcribe the audio chunk
-                            transcribe_chunk(chunk_file, base_name, cumulative_time, output_file)
-                            cumulative_time += CHUNK_LENGTH_SECONDS
-
-                qprint(f"Transcript saved to: {output_file}")
-
-                # Clean up the temporary chunk files after processing the current file
-                for chunk_file in chunks:
-                    os.remove(chunk_file)
-                    qprint(f"Deleted temporary chunk file: {chunk_file}")
-            except Exception as e:
-                print(f"Error in transcribing {file_name} in {folder_path}\n Error info in meta in {outfolder}/polished/metadata.txt")
-                meta_update(f"Error in transcribing {file_name}",f"Error info: \n{str(e)}")
-                return "Error"
+def chunk_layout() -> str:
+    """
+    How this run lays out the chunks of a file. Split mode with speech detection cuts in silences, every other mode on a grid,
+    and the chunk length follows the memory budget, so a journal is only resumed by a run that cuts the very same chunks.
+    """
+    boundaries = "silence" if run_mode() == "split" and args.chunk_silence else "grid"
+    return f"{boundaries}-{CHUNK_LENGTH_SECONDS}"
+
+# A journal written with another chunk layout is never resumed, clean_journals removes it and the file starts over
+def journal_name(key):
+    return f"{key}-{chunk_layout()}"
+
+def speaker_journal(job, base_name):
+    return journal_dir(job["outfolder"], journal_name(job["keys"][base_name]))
+
+# Writes the journaled chunks of a finished speaker file into its transcript and records it in the cache
+def commit_transcript(job, base_name):
+    output_file = os.path.join(job["outfolder"], f"{base_name}{RECORD_EXTENSION}")
+    assemble_journal(speaker_journal(job, base_name), output_file)
+    qprint(f"Transcript saved to: {output_file}")
+    job["cache"]["transcripts"][job["keys"][base_name]] = base_name
+    save_cache(job["outfolder"], job["cache"])
+
+# The metrics are written along with metadata.txt, so an interrupted or failed run still leaves its timings behind
+def job_meta(job, status, error = "", files = None):
+    if files is None:
+        files = job["audiofiles"]
+    update_meta(folder_path=job["polish_dir"],title=job["folder_name"],audiofiles=files,compute=args.compute_type,device=args.device,start_time=job["start_time"],error=error,status=status,model=job["model_name"])
+    job["metrics"]["status"] = status
+    write_metrics(job["polish_dir"], job["metrics"])
+    if args.prometheus:
+        write_prometheus(args.prometheus, run_metrics.values())
+
+def run_mode() -> str:
+    if args.live:
+        return "live"
+    if args.batch_size > 0:
+        return "batched"
+    if args.workers > 1:
+        return "workers"
+    return "stream" if args.stream else "split"
+
+def folder_to_txt(folder_path: str, folder_name: str, job=None) -> str: 
+    job = folder_job(folder_path, folder_name, job)
+    if job["error"]:
+        return "Error"
+    if job["up_to_date"]:
+        return "Completed"
+    outfolder = job["outfolder"]
+    files = job["transcribe"]
+
+    if files and args.batch_size > 0:
+        job["audiofiles"].extend(files)
+        job_meta(job, "Transcribing batched")
+        try:
+            journals = {sources.speaker_name(file_name): speaker_journal(job, sources.speaker_name(file_name)) for file_name in files}
+            with timed(job["metrics"], "model_load"):
+                load_batched_model()
+            transcribe_folder_batched(folder_path, files, journals, job["metrics"])
+            for file_name in files:
+                commit_transcript(job, sources.speaker_name(file_name))
+        except Exception as e:
+            print(f"Error in transcribing {folder_path}\n Error info in meta in {outfolder}/polished/metadata.txt")
+            job_meta(job, "Error in batched transcription",f"Error info: \n{str(e)}")
+            return "Error"
+    elif files:
+        # Every file is queued for cutting right away, the segmenter works one file ahead of the model
+        segmenter = None
+        if not args.stream:
+            segmenter = new_segmenter()
+            for file_name in files:
+                base_name = sources.speaker_name(file_name)
+                prefetch_split(segmenter, os.path.join(folder_path, file_name), base_name, speaker_journal(job, base_name))
+        try:
+            for file_name in files:
+                job["audiofiles"].append(file_name)
+                file_path = os.path.join(folder_path, file_name)
+                qprint(f"Processing file: {file_path}")
+
+                # The speaker name, the file name without its extension or Craig's track number
+                base_name = sources.speaker_name(file_name)
+                job_meta(job, "Transcribing "+ file_name)
+
+                try:
+                    # Loaded up front so the first chunk's timings are not mixed up with loading the model
+                    with timed(job["metrics"], "model_load"):
+                        load_model()
+                    if args.stream:
+                        transcribe_stream(file_path, base_name, speaker_journal(job, base_name), file_metrics(job["metrics"], base_name))
+                    else:
+                        transcribe_split(file_path, base_name, speaker_journal(job, base_name), file_metrics(job["metrics"], base_name), segmenter)
+
+                    commit_transcript(job, base_name)
+                except Exception as e:
+                    print(f"Error in transcribing {file_name} in {folder_path}\n Error info in meta in {outfolder}/polished/metadata.txt")
+                    job_meta(job, f"Error in transcribing {file_name}",f"Error info: \n{str(e)}")
+                    return "Error"
+        finally:
+            if segmenter is not None:
+                segmenter.close()
 
     qprint("Batch transcription complete!")
+    return finish_folder(job)
+
+# Where every output format of a folder is written, the md copy goes to the completed folder
+def output_paths(job) -> dict:
+    outputs = {"jsonl": os.path.join(job["polish_dir"],f"merged{RECORD_EXTENSION}")}
+    for output_format in args.formats:
+        if output_format == "md":
+            outputs["md"] = os.path.join(copy_dir,job["model_name"],f"{job['folder_name']}.md")
+        else:
+            outputs[output_format] = os.path.join(job["polish_dir"],f"{job['folder_name']}.{output_format}")
+    return outputs
+
+# Merges the speaker transcripts of a folder once all of them are done and renders every output format in one pass
+def finish_folder(job) -> str:
+    outfolder = job["outfolder"]
+    polish_dir = job["polish_dir"]
     qprint("Merging and Fromatting transcripts")
-    mergedfile = os.path.join(polish_dir,f"merged.txt")
-    completed_file = os.path.join(polish_dir,f"{folder_name}.txt")
-    completed_copy_dir = os.path.join(copy_dir,MODEL_NAME)
-    os.makedirs(completed_copy_dir, exist_ok=True)
-    completed_copy = os.path.join(completed_copy_dir,f"{folder_name}.md")
-    headerfile = os.path.join(folder_path,"header.txt")
-    header = ""
-    if os.path.isfile(headerfile):
-        with open(headerfile, "r") as f:
-            header = f.read()
+    os.makedirs(os.path.join(copy_dir,job["model_name"]), exist_ok=True)
+    header = read_header(job["folder_path"])
     try:
-        merge.merge_folder(output_file=mergedfile,transcripts_folder=outfolder)
-        format.format_with_header(merged_file=mergedfile,output_file=completed_file,header=header)
-        format.format_with_header(merged_file=mergedfile,output_file=completed_copy,header=header,format="md")
+        with timed(job["metrics"], "merge_render"):
+            bleed = {}
+            format.render(merge.merged_records(outfolder, args.bleed_window, bleed), output_paths(job), header=header)
+            job["metrics"]["bleed_suppressed"] = bleed.get("bleed", 0)
     except Exception as e:
         print(f"Error in merging and formatting {outfolder} Error info in meta in {outfolder}/polished/metadata.txt")
-        meta_update("Completed",str(e),files=files)
+        job_meta(job, "Completed",str(e),files=job["files"])
         return "Error"
-    meta_update("Completed",files=files)
+    index_transcript(job)
+    job_meta(job, "Completed",files=job["files"])
+    job["cache"]["rendered"] = job["render_key"]
+    save_cache(outfolder, job["cache"])
     with open(os.path.join(polish_dir,"metadata.txt"),"r", encoding="utf-8") as f:
         print(f.read())
     return "Completed"
 
-folders_to_txt(audio_dir)
+# The search index is only a convenience, a failure is reported but never fails the folder
+def index_transcript(job):
+    try:
+        with timed(job["metrics"], "index"):
+            count = search.index_session(os.path.join(output_dir, search.INDEX_FILE), job["folder_name"], job["model_name"], output_paths(job)["jsonl"], job["render_key"])
+        if count is not None:
+            qprint(f"Indexed {count} lines for search")
+    except Exception as e:
+        print(f"Error in indexing {job['folder_name']} for search. Reason: {e}")
+
+def schedule_folders(dir_path: str, planned: dict):
+    """
+    Plans every pending chunk of every speaker file in every folder up front and hands them out longest first
+    to a pool of worker processes, each loading its own model with its share of the cpu threads.
+    A folder is merged and formatted as soon as its last chunk is done, while the other folders keep the workers busy.
+    """
+    jobs = {}
+    units = []  # (audio length, folder name, base name, file path, chunk starts)
+    for fold_name, job in planned.items():
+        job = folder_job(os.path.join(dir_path,fold_name),fold_name, job)
+        jobs[fold_name] = job
+        job["pending"] = {}
+        if job["error"]:
+            print(f"Folder {fold_name} done with status Error")
+            continue
+        if job["up_to_date"]:
+            continue
+        if job["transcribe"]:
+            job["audiofiles"].extend(job["transcribe"])
+            try:
+                for file_name in job["transcribe"]:
+                    base_name = sources.speaker_name(file_name)
+                    file_path = os.path.join(job["folder_path"], file_name)
+                    with timed(file_metrics(job["metrics"], base_name), "probe"):
+                        duration = audio.probe_duration(file_path)
+                    # Chunks already in the journal of an interrupted run are not planned again
+                    done = finished_chunks(speaker_journal(job, base_name))
+                    starts = [start for start in range(0, math.ceil(duration), CHUNK_LENGTH_SECONDS) if chunk_id(start) not in done]
+                    if not starts:
+                        commit_transcript(job, base_name)
+                        continue
+                    job["pending"][base_name] = len(starts)
+                    if sources.split_member(file_name)[1] is not None:
+                        # A track in a zip can not seek, every chunk would decompress it from the start again, so one worker streams all of it
+                        units.append((duration - starts[0], fold_name, base_name, file_path, starts))
+                        continue
+                    for start in starts:
+                        units.append((min(CHUNK_LENGTH_SECONDS, duration - start), fold_name, base_name, file_path, [start]))
+            except Exception as e:
+                print(f"Error in planning {fold_name}\n Error info in meta in {job['outfolder']}/polished/metadata.txt")
+                job_meta(job, "Error in planning",f"Error info: \n{str(e)}")
+                units = [unit for unit in units if unit[1] != fold_name]
+                job["pending"] = {}
+                job["error"] = str(e)
+                continue
+            job_meta(job, f"Transcribing {sum(job['pending'].values())} chunks")
+        if not any(job["pending"].values()):
+            print(f"Folder {fold_name} done with status {finish_folder(job)}")
+
+    if not units:
+        return
+    # Longest chunks first so the short tails fill the gaps at the end of the run
+    units.sort(key=lambda unit: unit[0], reverse=True)
+    cpu_threads = model_cpu_threads(args.workers)
+    qprint(f"Scheduling {len(units)} chunks on {args.workers} workers with {cpu_threads} cpu threads each")
+
+    # fork is safe because the main process never loads the model itself, every worker loads its own
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("fork"), initializer=load_model, initargs=(cpu_threads,)) as executor:
+        futures = {}
+        for _, fold_name, base_name, file_path, starts in units:
+            futures[executor.submit(transcribe_unit, file_path, base_name, starts)] = (fold_name, base_name, starts)
+
+        for future in as_completed(futures):
+            fold_name, base_name, starts = futures[future]
+            job = jobs[fold_name]
+            try:
+                for start, records, unit in future.result():
+                    lines = [record_line(record) for record in records]
+                    commit_chunk(speaker_journal(job, base_name), start, lines)
+                    record_unit(job, base_name, start, unit, len(lines))
+            except Exception as e:
+                if not job["error"]:
+                    print(f"Error in transcribing {base_name} in {job['folder_path']}\n Error info in meta in {job['outfolder']}/polished/metadata.txt")
+                    job_meta(job, f"Error in transcribing {base_name}",f"Error info: \n{str(e)}")
+                job["error"] = str(e)
+            job["pending"][base_name] -= len(starts)
+
+            # A speaker is written in chunk order once all of its chunks are journaled
+            if job["pending"][base_name] == 0 and not job["error"]:
+                commit_transcript(job, base_name)
+
+            if not any(job["pending"].values()):
+                stat = "Error" if job["error"] else finish_folder(job)
+                print(f"Folder {fold_name} done with status {stat}")
+
+# (chunk start, samples) of the chunks of a unit, a recording seeks to every chunk and a track in a zip is streamed once from its first chunk on
+def unit_chunks(file_path, starts):
+    if sources.split_member(file_path)[1] is None:
+        for start in starts:
+            yield start, audio.decode_pcm(file_path, start, CHUNK_LENGTH_SECONDS)
+        return
+    wanted = {chunk_id(start) for start in starts}
+    for offset, samples in audio.stream_pcm(file_path, CHUNK_LENGTH_SECONDS, start=starts[0]):
+        if chunk_id(offset) in wanted:
+            yield offset, samples
+
+# Runs in a worker process, decodes the chunks of a unit and returns (chunk start, records, timings) of each of them,
+# the records with times relative to the whole file. The worker's model load time comes along with its first chunk
+def transcribe_unit(file_path, base_name, starts):
+    global model_load_seconds
+    results = []
+    chunks = unit_chunks(file_path, starts)
+    while True:
+        started = time.perf_counter()
+        chunk = next(chunks, None)
+        if chunk is None:
+            return results
+        chunk_start, samples = chunk
+        unit = {"stages": {"decode": time.perf_counter() - started}, "model_load": model_load_seconds}
+        model_load_seconds = 0.0
+        clips = stream_clips(samples, unit)
+        started = time.perf_counter()
+        records = [chunk_record(base_name, segment, chunk_start) for segment in transcribe_segments(samples, chunk_start, clips)]
+        unit["inference"] = time.perf_counter() - started
+        unit["audio_seconds"] = len(samples) / audio.SAMPLE_RATE
+        unit["speech_seconds"] = clip_seconds(clips)
+        results.append((chunk_start, records, unit))
+
+# Adds the timings a worker sent back for a chunk to the metrics of its folder,
+# a worker's model load counts towards the folder of the first chunk it happened to get
+def record_unit(job, base_name, chunk_start, unit, segments):
+    section = file_metrics(job["metrics"], base_name)
+    for stage, seconds in unit["stages"].items():
+        add_time(section, stage, seconds)
+    add_time(job["metrics"], "model_load", unit["model_load"])
+    add_chunk(section, chunk_start, unit["audio_seconds"], unit["speech_seconds"], unit["inference"], segments)
+
+# Times the settings on a sample of the recordings and saves the fastest one for the following runs
+def tune_run():
+    if args.compute_type != "auto":
+        compute_types = [args.compute_type]
+    elif args.device == "cuda":
+        compute_types = ["float16", "int8_float16"]
+    else:
+        compute_types = ["int8", "float32"]
+    sample = tune.tuning_sample(audio_dir, args.tune_seconds)
+    best = tune.calibrate(args.model, args.device, compute_types, sample)
+    if best is None:
+        print("No setting worked within the memory limit, nothing was saved")
+        return
+    tuning_path = tune.save_tuning(output_dir, tune.tuning_key(args.model, args.device), best)
+    print(f"Fastest: {best['workers']} workers, {best['threads']} threads, {best['cpu_threads']} cpu threads, {best['compute_type']} at {best['speed']}x realtime")
+    print(f"Saved to {tuning_path}, runs with the same model, device and limits use it from now on")
+
+def main(argv=None):
+    global args, CHUNK_LENGTH_SECONDS
+    args = parse_args(argv)
+    apply_tuning(args)
+    # Watch mode keeps one warm model, so the chunks are cut, journaled and budgeted like a single model run
+    if args.watch and args.workers > 1:
+        print("Watch mode transcribes with one warm model, -w is ignored")
+        args.workers = 1
+    CHUNK_LENGTH_SECONDS = chunk_length()
+    if args.tune:
+        os.makedirs(output_dir, exist_ok=True)
+        tune_run()
+        return
+
+    # Nothing is created, cleaned or loaded when every folder is already done
+    pending = None
+    if args.plan or not (args.watch or args.live):
+        pending = plan_folders(audio_dir)
+        if args.plan or not pending:
+            return
+
+    # Ensure the output directory exists
+    os.makedirs(output_dir, exist_ok=True)
+    os.makedirs(tmpfiles, exist_ok=True)
+    os.makedirs(copy_dir, exist_ok=True)
+
+    # Clean any possible remenants of an old run
+    cleandir(tmpfiles)
+    #cleandir(output_dir)
+    #cleandir(polish_dir)
+
+    if args.live:
+        live_folders(audio_dir)
+    elif args.watch:
+        watch_folders(audio_dir)
+    else:
+        folders_to_txt(audio_dir, pending)
+
+if __name__ == "__main__":
+    main()
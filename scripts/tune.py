@@ -0,0 +1,270 @@
+import os
+import json
+import math
+import time
+import resource
+import multiprocessing
+import queue
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import audio
+import sources
+
+# Calibration of how the cores are shared out: worker processes with their own model, threads sharing one model
+# (num_workers) and the cpu_threads of every model. The fastest setting that fits in memory is saved per model,
+# device and container limits, so normal runs pick it up without guessing.
+TUNING_FILE = "tuning.json"
+# Part of the memory limit a setting may use, the rest is left for ffmpeg, decoded chunks and the merge
+MEMORY_HEADROOM = 0.85
+
+# Host memory a second of audio takes while its chunk is transcribed: the decoded samples and the spectrogram
+# faster-whisper computes for the whole chunk at once, with the stft in between, rounded up generously
+CHUNK_BYTES_PER_SECOND = 512 * 1024
+MIN_CHUNK_SECONDS = 300
+# Longer chunks save next to nothing, every chunk boundary is in a silence anyway
+MAX_CHUNK_SECONDS = 3600
+# Parameters of the whisper models by a part of their name, checked in this order so large-v3-turbo is a turbo
+MODEL_PARAMETERS = {"tiny": 39e6, "base": 74e6, "small": 244e6, "medium": 769e6, "turbo": 809e6, "distil": 756e6, "large": 1550e6}
+WEIGHT_BYTES = {"float32": 4, "float16": 2, "bfloat16": 2, "int8_float32": 1, "int8_float16": 1, "int8_bfloat16": 1, "int8": 1}
+# Runtime, cuda context and buffers of every process that loads a model
+MODEL_OVERHEAD = 512 * 1024 * 1024
+
+
+def available_cpus() -> int:
+    """Cores this process may use, the cgroup cpu quota of the container wins over the cores it can see."""
+    cpus = len(os.sched_getaffinity(0))
+    quota = None
+    try:
+        # cgroup v2, "max 100000" when there is no limit
+        with open("/sys/fs/cgroup/cpu.max", "r") as f:
+            limit, period = f.read().split()
+        if limit != "max":
+            quota = int(limit) / int(period)
+    except (OSError, ValueError):
+        try:
+            # cgroup v1, -1 when there is no limit
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "r") as f:
+                limit = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us", "r") as f:
+                period = int(f.read())
+            if limit > 0:
+                quota = limit / period
+        except (OSError, ValueError):
+            pass
+    if quota is not None:
+        cpus = min(cpus, max(1, math.floor(quota)))
+    return cpus
+
+def memory_limit():
+    """Memory limit of the container in bytes, None when there is none."""
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path, "r") as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value == "max":
+            return None
+        # cgroup v1 reports a huge number when there is no limit
+        if int(value) < 1 << 60:
+            return int(value)
+        return None
+    return None
+
+def model_bytes(model_name, device, compute_type):
+    """Host memory one loaded model takes, on a gpu the weights live in gpu memory."""
+    if device == "cuda":
+        return MODEL_OVERHEAD
+    name = (model_name or "").lower()
+    parameters = next((count for part, count in MODEL_PARAMETERS.items() if part in name), MODEL_PARAMETERS["large"])
+    # default runs a cpu model in float32
+    return parameters * WEIGHT_BYTES.get(compute_type, 4) + MODEL_OVERHEAD
+
+def chunk_target(memory, model_name, device, compute_type, processes=1, threads=1, reserved=0):
+    """
+    Longest chunk in seconds whose audio fits in the memory budget next to the models, None without a budget.
+    Every thread of every process has a chunk in flight plus one decoded or cut ahead, reserved is taken off first,
+    like the chunk spool in the temporary folder when that is kept in memory.
+    """
+    if not memory:
+        return None
+    budget = memory * MEMORY_HEADROOM - reserved - processes * model_bytes(model_name, device, compute_type)
+    seconds = budget / (processes * threads + 1) / CHUNK_BYTES_PER_SECOND
+    if seconds < MIN_CHUNK_SECONDS:
+        print(f"Warning: the models barely fit in {memory / 1024 ** 3:.1f}GB, chunks are kept at the minimum of {MIN_CHUNK_SECONDS} seconds")
+    # Whole minutes, so a few bytes more or less memory do not change the chunk length
+    return int(max(MIN_CHUNK_SECONDS, min(MAX_CHUNK_SECONDS, seconds)) // 60 * 60)
+
+def tuning_key(model_name, device, cpus=None, memory=None):
+    # A setting only holds for the model, device and limits it was measured with
+    cpus = available_cpus() if cpus is None else cpus
+    memory = memory_limit() if memory is None else memory
+    return f"{model_name}|{device}|{cpus}cpu|{f'{round(memory / 1024 ** 3, 1)}GB' if memory else 'unlimited'}"
+
+def load_tuning(folder, key):
+    tuning_path = os.path.join(folder, TUNING_FILE)
+    if not os.path.isfile(tuning_path):
+        return None
+    try:
+        with open(tuning_path, "r", encoding="utf-8") as f:
+            return json.load(f).get(key)
+    except (ValueError, OSError) as e:
+        print(f"Ignoring unreadable tuning {tuning_path}. Reason: {e}")
+        return None
+
+def save_tuning(folder, key, setting):
+    tuning_path = os.path.join(folder, TUNING_FILE)
+    tunings = {}
+    if os.path.isfile(tuning_path):
+        try:
+            with open(tuning_path, "r", encoding="utf-8") as f:
+                tunings = json.load(f)
+        except (ValueError, OSError):
+            pass
+    tunings[key] = setting
+    with open(tuning_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(tunings, f, indent=1)
+    os.replace(tuning_path + ".tmp", tuning_path)
+    return tuning_path
+
+def synthetic_sample(seconds):
+    # Voice like bursts of a wandering tone with some noise, only used when there is no audio to take a sample from
+    t = np.arange(int(seconds * audio.SAMPLE_RATE), dtype=np.float32) / audio.SAMPLE_RATE
+    pitch = 140 + 60 * np.sin(2 * np.pi * 0.7 * t)
+    bursts = (np.sin(2 * np.pi * 0.25 * t) > -0.3).astype(np.float32)
+    rng = np.random.default_rng(0)
+    return (bursts * (0.3 * np.sin(2 * np.pi * np.cumsum(pitch) / audio.SAMPLE_RATE) + 0.02 * rng.standard_normal(len(t)))).astype(np.float32)
+
+def tuning_sample(audio_dir, seconds=30, search_seconds=600):
+    """
+    The audio every setting is timed on, seconds of speech from the start of the largest recording in audio_dir
+    so the timings match real sessions. Falls back to a synthesized sample when there are no recordings.
+    """
+    recordings = []
+    if os.path.isdir(audio_dir):
+        for root, _, files in os.walk(audio_dir):
+            recordings.extend(os.path.join(root, f) for f in files if sources.is_audio(f))
+    if recordings:
+        recording = max(recordings, key=os.path.getsize)
+        samples = audio.decode_pcm(recording, 0, search_seconds)
+        pieces = []
+        length = 0
+        for start, end in audio.detect_speech_pcm(samples):
+            piece = samples[int(start * audio.SAMPLE_RATE):int(end * audio.SAMPLE_RATE)]
+            pieces.append(piece)
+            length += len(piece)
+            if length >= seconds * audio.SAMPLE_RATE:
+                break
+        if length >= seconds * audio.SAMPLE_RATE / 2:
+            print(f"Tuning on {length / audio.SAMPLE_RATE:.0f} seconds of speech from {recording}")
+            return np.concatenate(pieces)[:int(seconds * audio.SAMPLE_RATE)].copy()
+    print("No recordings with enough speech found, tuning on a synthesized sample. The timings are only a rough guide")
+    return synthetic_sample(seconds)
+
+def candidates(cpus, device, compute_types):
+    """
+    Every setting worth timing, as (workers, threads, cpu_threads, compute type).
+    Either several worker processes with one model each, or threads sharing one model, never both,
+    and the cores are always shared out evenly so nothing is oversubscribed.
+    """
+    counts = sorted({1, 2, 4, cpus // 2, cpus} - {0})
+    counts = [count for count in counts if count <= cpus]
+    settings = []
+    for compute_type in compute_types:
+        for count in counts:
+            cpu_threads = max(1, cpus // count)
+            settings.append((1, count, cpu_threads, compute_type) if count > 1 else (1, 1, cpus, compute_type))
+            # A gpu is shared by every worker process, one model with threads is all that makes sense there
+            if count > 1 and device != "cuda":
+                settings.append((count, 1, cpu_threads, compute_type))
+    return settings
+
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def time_worker(results, barrier, model_name, device, threads, cpu_threads, compute_type, sample):
+    # Runs in a forked process, loads its own model and transcribes the sample once per thread after all workers are loaded
+    from faster_whisper import WhisperModel
+    try:
+        started = time.perf_counter()
+        model = WhisperModel(model_name, device=device, compute_type=compute_type, cpu_threads=cpu_threads, num_workers=threads)
+        load_seconds = time.perf_counter() - started
+        barrier.wait()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = [executor.submit(lambda: list(model.transcribe(sample, language="en")[0])) for _ in range(threads)]
+            for future in futures:
+                future.result()
+        results.put((load_seconds, time.perf_counter() - started, peak_rss(), ""))
+    except Exception as e:
+        barrier.abort()
+        results.put((0.0, 0.0, peak_rss(), str(e)))
+
+def time_setting(model_name, device, setting, sample):
+    """Time one setting in fresh processes, returns the seconds of audio transcribed per second and the memory all workers used."""
+    workers, threads, cpu_threads, compute_type = setting
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    barrier = context.Barrier(workers)
+    processes = [
+        context.Process(target=time_worker, args=(results, barrier, model_name, device, threads, cpu_threads, compute_type, sample))
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    while any(process.is_alive() for process in processes):
+        for process in processes:
+            process.join(timeout=1)
+            # The others would wait for a dead worker at the barrier forever
+            if process.exitcode not in (None, 0):
+                barrier.abort()
+    outcomes = []
+    for _ in processes:
+        try:
+            outcomes.append(results.get(timeout=1))
+        except queue.Empty:
+            break
+    errors = [outcome[3] for outcome in outcomes if outcome[3]]
+    # A worker killed by the kernel, most likely for running out of memory, never reports back
+    if len(outcomes) < workers or any(process.exitcode != 0 for process in processes):
+        errors.append("a worker process died, most likely out of memory")
+    if errors:
+        return {"error": errors[0]}
+    wall = max(outcome[1] for outcome in outcomes)
+    audio_seconds = len(sample) / audio.SAMPLE_RATE * workers * threads
+    return {
+        "speed": round(audio_seconds / wall, 2),
+        "memory": sum(outcome[2] for outcome in outcomes),
+        "load_seconds": round(max(outcome[0] for outcome in outcomes), 2),
+    }
+
+def calibrate(model_name, device, compute_types, sample, cpus=None, memory=None):
+    """
+    Time every candidate setting on the sample and return the fastest one that stays inside the memory limit.
+    Settings that would clearly not fit, going by the memory one worker of the same compute type used, are skipped untimed.
+    """
+    cpus = available_cpus() if cpus is None else cpus
+    memory = memory_limit() if memory is None else memory
+    budget = memory * MEMORY_HEADROOM if memory else None
+    print(f"Tuning {model_name} on {device} with {cpus} cpus and {f'{memory / 1024 ** 3:.1f}GB' if memory else 'no'} memory limit")
+    single_worker = {}  # memory of one worker per compute type
+    best = None
+    for setting in candidates(cpus, device, compute_types):
+        workers, threads, cpu_threads, compute_type = setting
+        name = f"{workers} workers x {threads} threads x {cpu_threads} cpu_threads, {compute_type}"
+        if budget and compute_type in single_worker and single_worker[compute_type] * workers > budget:
+            print(f"{name:<50} skipped, needs about {single_worker[compute_type] * workers / 1024 ** 3:.1f}GB")
+            continue
+        result = time_setting(model_name, device, setting, sample)
+        if "error" in result:
+            print(f"{name:<50} failed: {result['error']}")
+            continue
+        single_worker.setdefault(compute_type, result["memory"] / workers)
+        fits = budget is None or result["memory"] <= budget
+        print(f"{name:<50} {result['speed']:6.2f}x realtime  {result['memory'] / 1024 ** 3:5.1f}GB{'' if fits else '  over the memory limit'}")
+        if fits and (best is None or result["speed"] > best["speed"]):
+            best = {
+                "workers": workers, "threads": threads, "cpu_threads": cpu_threads, "compute_type": compute_type,
+                "speed": result["speed"], "memory": result["memory"], "tuned": time.ctime(),
+            }
+    return best
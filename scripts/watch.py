@@ -0,0 +1,183 @@
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Watch mode keeps one process with a warm model running and transcribes session folders as they show up in the audio folder.
+# inotify only wakes the loop up, the folders are always rescanned to see what changed, so a missed event costs nothing
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+
+class InotifyWatcher:
+    """Wakes up on any change in the watched folders, through the inotify calls of libc."""
+    kind = "inotify"
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def watch(self, path):
+        # Watching a folder again is a no-op, so every scan simply adds all folders
+        if self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK) < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+
+    def wait(self, timeout):
+        """True when something changed within timeout seconds."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        # Only the fact that something changed matters, the events themselves are thrown away
+        while True:
+            try:
+                if not os.read(self.fd, 65536):
+                    break
+            except BlockingIOError:
+                break
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+class PollWatcher:
+    """Fallback for where inotify does not work, like network shares, every wait simply ends in a rescan."""
+    kind = "polling"
+
+    def watch(self, path):
+        pass
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return True
+
+    def close(self):
+        pass
+
+def make_watcher():
+    try:
+        return InotifyWatcher()
+    except (OSError, AttributeError) as e:
+        print(f"inotify is not available, polling instead. Reason: {e}")
+        return PollWatcher()
+
+def folder_state(folder_path, extensions):
+    """Name, size and mtime of every audio file in the folder, any change to the recordings changes the state."""
+    state = []
+    for name in sorted(os.listdir(folder_path)):
+        file_path = os.path.join(folder_path, name)
+        if name.lower().endswith(extensions) and os.path.isfile(file_path):
+            stat = os.stat(file_path)
+            state.append((name, stat.st_size, stat.st_mtime_ns))
+    return tuple(state)
+
+class SessionTracker:
+    """
+    Remembers how every session folder looked when it was last seen and when it was last transcribed.
+    A folder is ready once its recordings have not changed for settle seconds and differ from what was transcribed,
+    so a folder that is still being copied in is left alone until the copy is done.
+    """
+
+    def __init__(self, settle, extensions=(".mp3",)):
+        self.settle = settle
+        self.extensions = extensions
+        self.seen = {}  # folder name: (state, time of the last change)
+        self.done = {}  # folder name: state it was transcribed in
+
+    def scan(self, dir_path, now=None):
+        """Returns (folder name, state) of every folder ready to be transcribed."""
+        now = time.time() if now is None else now
+        ready = []
+        names = set()
+        for name in sorted(os.listdir(dir_path)):
+            folder_path = os.path.join(dir_path, name)
+            if not os.path.isdir(folder_path):
+                continue
+            try:
+                state = folder_state(folder_path, self.extensions)
+            except OSError:
+                continue  # Removed or renamed while scanning, the next scan sees it
+            names.add(name)
+            seen = self.seen.get(name)
+            if seen is None:
+                # Folders that were already there count as changed when their newest file was written
+                since = max((entry[2] / 1e9 for entry in state), default=now)
+                self.seen[name] = (state, min(since, now))
+            elif seen[0] != state:
+                self.seen[name] = (state, now)
+            state, since = self.seen[name]
+            if state and state != self.done.get(name) and now - since >= self.settle:
+                ready.append((name, state))
+        for name in set(self.seen) - names:
+            del self.seen[name]
+            self.done.pop(name, None)
+        return ready
+
+    def changing(self, now=None):
+        """Folders whose recordings changed within the last settle seconds, like a session that is still being recorded."""
+        now = time.time() if now is None else now
+        return [name for name, (state, since) in sorted(self.seen.items()) if state and now - since < self.settle]
+
+    def mark_done(self, name, state):
+        self.done[name] = state
+
+class Status:
+    """What the daemon is doing, shared between the transcription loop and the status endpoint."""
+
+    def __init__(self, **info):
+        self.lock = threading.Lock()
+        self.data = {"started": time.ctime(), **info, "state": "starting", "current": None, "queue": [], "folders": {}}
+
+    def update(self, **changes):
+        with self.lock:
+            self.data.update(changes)
+
+    def finish(self, folder_name, status):
+        with self.lock:
+            self.data["folders"][folder_name] = {"status": status, "finished": time.ctime()}
+            self.data["current"] = None
+
+    def snapshot(self):
+        with self.lock:
+            return json.loads(json.dumps(self.data))
+
+def serve(host, port, routes):
+    """
+    Small json http endpoint in a background thread, routes maps a path to a function of the query string.
+    Only meant for the local machine or the docker network, there is no authentication.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path, _, query = self.path.partition("?")
+            route = routes.get(path)
+            if route is None:
+                self.send_error(404)
+                return
+            try:
+                body = json.dumps(route(query), indent=1).encode("utf-8")
+            except Exception as e:
+                self.send_error(500, str(e))
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server